@@ -0,0 +1,155 @@
+"""
+Runs many VirusModels across a pool of processes. A parallel replacement for mesa's BatchRunner.
+"""
+
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from burnin import BurnInCache
+from model import DEFAULT_SEED, VirusModel
+from writer import StrainWriter, default_format
+
+
+def run_model(model_cls, kwargs, max_steps, burn_in_steps=0, burn_in_cache=None, output_path=None):
+    """
+    Runs one model for max_steps steps and returns its data collector.
+    Only the collector is sent back to the parent process, which holds per step strain counts.
+
+    Args:
+        model_cls: The model class to run.
+        kwargs: Keyword arguments to make the model with.
+        max_steps: Number of steps to run for, counting the burn in.
+        burn_in_steps: Number of steps to run before collecting. They are not in the collector.
+        burn_in_cache: Directory of a BurnInCache to get burned in models from, or None to always run the burn in.
+        output_path: If set, strain counts are streamed to a StrainWriter at this path as the model runs,
+            instead of kept in the collector.
+    """
+
+    if burn_in_cache is not None and burn_in_steps:
+        model = BurnInCache(burn_in_cache).get_model(model_cls, kwargs, burn_in_steps)
+    else:
+        model = model_cls(**kwargs)
+        if burn_in_steps:
+            while model.running and model.schedule.steps < burn_in_steps:
+                model.step()
+            model.datacollector.clear()
+    if output_path is not None:
+        model.datacollector.stream(StrainWriter(output_path, model.datacollector.species))
+    while model.running and model.schedule.steps < max_steps:
+        model.step()
+    model.datacollector.close()
+    return model.datacollector
+
+
+class ParallelBatchRunner:
+
+    def __init__(self, model_cls=VirusModel, variable_parameters=None, fixed_parameters=None, iterations=1,
+                 max_steps=1000, processes=None, seed=DEFAULT_SEED, burn_in_steps=0, burn_in_cache=None,
+                 output_dir=None):
+        """
+        Runs every combination of the variable parameters iterations times, spread over a pool of processes.
+        Takes the same arguments as mesa's BatchRunner.
+
+        Args:
+            model_cls: The model class to run.
+            variable_parameters: Dictionary of parameter names to lists of values to try.
+            fixed_parameters: Dictionary of parameters that are the same for every run.
+            iterations: Number of times to run each combination.
+            max_steps: Number of steps to run each model for.
+            processes: Number of worker processes. Defaults to the number of cores.
+            seed: Base seed of every run. Each run is its own replicate of it, numbered by its run count,
+                so a run gets the same random numbers whichever process it runs in.
+            burn_in_steps: Number of steps each model runs before its data is collected.
+            burn_in_cache: Directory of a BurnInCache, so runs whose arguments match an earlier run's
+                start from its burned in state instead of running the burn in again.
+            output_dir: If set, each run streams its strain counts to run_<run count> in this directory as it goes,
+                a Parquet directory when pyarrow is installed or else a CSV file. Memory then stays flat
+                however many steps are run, and runs that crash still leave what they got through.
+        """
+
+        self.model_cls = model_cls
+        self.variable_parameters = variable_parameters or {}
+        self.fixed_parameters = fixed_parameters or {}
+        self.iterations = iterations
+        self.max_steps = max_steps
+        self.processes = processes or os.cpu_count()
+        self.seed = seed
+        self.burn_in_steps = burn_in_steps
+        self.burn_in_cache = burn_in_cache
+        self.output_dir = output_dir
+
+        self.collectors = {}  # {(param1, param2, ..., run): StrainCollector}
+
+    def runs(self):
+        """Returns the key and model keyword arguments of every run, in the order BatchRunner does them."""
+
+        names = list(self.variable_parameters)
+        combinations = itertools.product(*self.variable_parameters.values())
+        runs = []
+        for run_count, (values, _) in enumerate(itertools.product(combinations, range(self.iterations))):
+            kwargs = {"seed": self.seed, "replicate": run_count}
+            kwargs.update(self.fixed_parameters)
+            kwargs.update(zip(names, values))
+            runs.append((tuple(values) + (run_count,), kwargs))
+        return runs
+
+    def run_all(self):
+        """Runs every model and stores their collectors."""
+
+        runs = self.runs()
+        if self.output_dir is not None:
+            os.makedirs(self.output_dir, exist_ok=True)
+
+        with ProcessPoolExecutor(max_workers=self.processes) as pool:
+            futures = [pool.submit(run_model, self.model_cls, kwargs, self.max_steps,
+                                   self.burn_in_steps, self.burn_in_cache, self.output_path(key))
+                       for key, kwargs in runs]
+            for (key, _), future in zip(runs, futures):
+                self.collectors[key] = future.result()
+
+    def output_path(self, key):
+        """Returns the path a run streams its strain counts to, or None when they are kept in memory."""
+
+        if self.output_dir is None:
+            return None
+        return os.path.join(self.output_dir, f"run_{key[-1]}.{default_format()}")
+
+    def get_strain_counts(self):
+        """Returns {(param1, param2, ..., run): steps x species x NUM_H x NUM_N array of strain counts}."""
+
+        return {key: collector.counts for key, collector in self.collectors.items()}
+
+    def get_collector_agents(self):
+        """Returns {(param1, param2, ..., run): strain count dataframe}, the same as BatchRunner."""
+
+        return {key: collector.get_agent_vars_dataframe() for key, collector in self.collectors.items()}
+
+    def get_stage_timings(self):
+        """
+        Returns the stage timings of every profiled run in one dataframe, with a column for each variable parameter and the run.
+        Runs are only profiled when profile=True is one of the fixed parameters.
+        """
+
+        frames = []
+        for key, collector in self.collectors.items():
+            if collector.profiler is None:
+                continue
+            frame = collector.profiler.get_dataframe()
+            for i, (name, value) in enumerate(zip(list(self.variable_parameters) + ["Run"], key)):
+                frame.insert(i, name, [value] * len(frame))
+            frames.append(frame)
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+    def get_strain_dataframe(self):
+        """Returns the strain counts of every run in one dataframe, with a column for each variable parameter and the run."""
+
+        frames = []
+        for key, frame in self.get_collector_agents().items():
+            frame = frame.reset_index()
+            for i, (name, value) in enumerate(zip(list(self.variable_parameters) + ["Run"], key)):
+                frame.insert(i, name, [value] * len(frame))
+            frames.append(frame)
+        return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,239 @@
+"""
+Scaling benchmarks of VirusModel. Runs each engine over a grid of population sizes, contact regimes and
+initial infection prevalences, and writes the speed, peak memory and stage timings of every case to a json file.
+
+    python benchmark.py --sizes 1000 10000 --engines agent vectorized --output results.json
+    python benchmark.py --compare old_results.json results.json
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+
+import numpy as np
+
+from model import (CONTACT_RATES, DEFAULT_SEED, ENGINES, EVENT_ENGINES, NUM_H, NUM_N, POPULATION_ENGINES, SPECIES,
+                   TRANSMISSIONS, VirusModel)
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+SIZES = [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6]
+
+# Mean number of contacts a host makes each step in each regime. The default contact rates
+# give about 30 contacts per host at the default population size.
+CONTACT_REGIMES = {"sparse": 1, "moderate": 5, "dense": 30}
+
+# Fraction of hosts infected with at least one virus at the start
+PREVALENCES = [0.01, 0.15, 0.5]
+
+# Largest population the per agent engines are run at by default. Making a million agents alone takes minutes.
+MAX_AGENT_HOSTS = 10 ** 5
+
+# Values of a case that identify it when comparing two results files
+CASE_KEYS = ["engine", "transmission", "hosts", "contacts", "prevalence"]
+
+
+def scaled_contact_rates(num_hosts, mean_contacts):
+    """
+    Returns CONTACT_RATES scaled so hosts of a population of num_hosts split evenly between the
+    species make mean_contacts contacts each step on average.
+
+    Contact counts are rounded down per species pair, so the actual mean is a little lower.
+    """
+
+    pool_size = num_hosts / len(SPECIES)
+    return CONTACT_RATES * mean_contacts * len(SPECIES) / (pool_size * CONTACT_RATES.sum())
+
+
+def virus_prob(prevalence):
+    """Returns the per virus infection probability that leaves a prevalence fraction of hosts infected."""
+
+    return 1 - (1 - prevalence) ** (1 / (NUM_H * NUM_N))
+
+
+def peak_rss_mb():
+    """Returns the peak resident memory of this process in megabytes, or None when it cannot be read."""
+
+    # On Linux ru_maxrss carries over the peak of the process a spawned one was started from,
+    # while VmHWM only counts the memory of the current program.
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 2 ** 10  # kilobytes
+    except OSError:  # Not Linux
+        pass
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10  # bytes on macOS, kilobytes on Linux
+
+
+def run_case(engine, transmission, num_hosts, regime, prevalence, steps, seed=DEFAULT_SEED):
+    """
+    Makes and runs one profiled model, and returns its timings.
+    Meant to be run in a fresh process, so the peak memory is that of this case alone.
+
+    Args:
+        engine: Engine of the model. One of ENGINES.
+        transmission: Transmission of the model. One of TRANSMISSIONS.
+        num_hosts: Number of hosts, split evenly between the species.
+        regime: Name of the contact regime in CONTACT_REGIMES.
+        prevalence: Fraction of hosts infected at the start.
+        steps: Number of steps to time.
+        seed: Seed of the model.
+    """
+
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):  # The model prints every step
+        start = time.perf_counter()
+        model = VirusModel(init_pop_size=[num_hosts // len(SPECIES)] * len(SPECIES), engine=engine,
+                           transmission=transmission,
+                           contact_rates=scaled_contact_rates(num_hosts, CONTACT_REGIMES[regime]),
+                           init_virus_prob=virus_prob(prevalence), seed=seed, profile=True)
+        setup_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(steps):
+            model.step()
+        seconds = time.perf_counter() - start
+
+    stages = model.profiler.summary()
+    return {
+        "engine": engine,
+        "transmission": transmission,
+        "hosts": num_hosts,
+        "contacts": regime,
+        "prevalence": prevalence,
+        "steps": steps,
+        "setup_seconds": setup_seconds,
+        "seconds": seconds,
+        "steps_per_sec": steps / seconds,
+        "host_steps_per_sec": steps * num_hosts / seconds,
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": {stage: {"seconds": row.Seconds, "share": row.Share, "hosts": int(row.Hosts), "draws": int(row.Draws)}
+                   for stage, row in stages.iterrows()},
+    }
+
+
+def run_benchmarks(engines, transmissions, sizes, regimes, prevalences, steps, max_agent_hosts=MAX_AGENT_HOSTS,
+                   on_result=None):
+    """
+    Runs every combination of the arguments, each in its own process, and returns their results.
+    A case that fails, or whose process dies such as when it runs out of memory, is recorded with its error
+    instead of a speed, and the rest still run.
+
+    Processes are spawned rather than forked, as a forked process starts with the peak memory of this one.
+
+    Args:
+        on_result: Called with the list of results so far after every case, such as to save them as they come.
+    """
+
+    results = []
+    for engine, transmission, num_hosts, regime, prevalence in itertools.product(
+            engines, transmissions, sizes, regimes, prevalences):
+        if engine not in POPULATION_ENGINES and num_hosts > max_agent_hosts:
+            print(f"Skipping {engine} with {num_hosts} hosts, above --max-agent-hosts")
+            continue
+        if engine in EVENT_ENGINES and transmission == "meanfield":
+            print(f"Skipping {engine} with {transmission} transmission, which it does not support")
+            continue
+
+        case = f"{engine:>10} {transmission:>8} {num_hosts:>8} hosts {regime:>8} {prevalence:>5.2f} infected:"
+        try:
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                result = pool.submit(run_case, engine, transmission, num_hosts, regime, prevalence, steps).result()
+        except Exception as error:  # Including BrokenProcessPool when the case is killed
+            result = {"engine": engine, "transmission": transmission, "hosts": num_hosts, "contacts": regime,
+                      "prevalence": prevalence, "steps": steps, "error": f"{type(error).__name__}: {error}"}
+            print(case, "failed with", result["error"])
+        else:
+            print(case, f"{result['steps_per_sec']:8.2f} steps/s {result['host_steps_per_sec']:12.0f} host steps/s "
+                        f"{result['peak_rss_mb'] or 0:8.1f} MB")
+        results.append(result)
+        if on_result is not None:
+            on_result(results)
+    return results
+
+
+def compare(old, new, threshold=0.8):
+    """
+    Prints the change in host steps per second of every case in both results, and returns
+    the cases that got slower than threshold times their old speed, or that failed when they used to run.
+    """
+
+    old_cases = {tuple(case[key] for key in CASE_KEYS): case for case in old["cases"]}
+    regressions = []
+    for case in new["cases"]:
+        key = tuple(case[k] for k in CASE_KEYS)
+        if key not in old_cases or "error" in old_cases[key]:
+            continue
+        if "error" in case:
+            print(" ".join(str(k) for k in key), "failed")
+            regressions.append(key)
+            continue
+        ratio = case["host_steps_per_sec"] / old_cases[key]["host_steps_per_sec"]
+        print(" ".join(str(k) for k in key), f"{ratio:.2f}x")
+        if ratio < threshold:
+            regressions.append(key)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engines", nargs="+", default=ENGINES, choices=ENGINES)
+    parser.add_argument("--transmissions", nargs="+", default=["contact"], choices=TRANSMISSIONS)
+    parser.add_argument("--sizes", nargs="+", type=int, default=SIZES)
+    parser.add_argument("--contacts", nargs="+", default=list(CONTACT_REGIMES), choices=list(CONTACT_REGIMES))
+    parser.add_argument("--prevalences", nargs="+", type=float, default=PREVALENCES)
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--max-agent-hosts", type=int, default=MAX_AGENT_HOSTS)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="Compare two results files instead of running, failing if a case got slower.")
+    parser.add_argument("--threshold", type=float, default=0.8,
+                        help="Slowest allowed fraction of the old speed when comparing.")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        old, new = (json.load(open(path)) for path in args.compare)
+        regressions = compare(old, new, args.threshold)
+        for key in regressions:
+            print("Regression:", " ".join(str(k) for k in key))
+        return 1 if regressions else 0
+
+    results = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cases": [],
+    }
+
+    def save(cases):
+        """Writes the results after every case, so an interrupted run keeps the cases it finished."""
+
+        results["cases"] = cases
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    save([])
+    run_benchmarks(args.engines, args.transmissions, args.sizes, args.contacts, args.prevalences,
+                   args.steps, args.max_agent_hosts, on_result=save)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,148 @@
+"""
+Cache of burned in models. Runs only become meaningful after a few hundred steps, so models that have run
+their burn in are checkpointed to disk, keyed by their arguments, and later runs with the same arguments start from there.
+"""
+
+import hashlib
+import inspect
+import os
+import pickle
+
+import numpy as np
+
+from network import ContactNetwork
+
+# Bumped when the way keys are made changes, so old cache entries are not mistaken for new ones.
+KEY_VERSION = 1
+
+
+def canonical(value):
+    """Returns a hashable stand in for an argument value, with arrays and networks replaced by digests of their data."""
+
+    if isinstance(value, ContactNetwork):
+        value = (value.indptr, value.indices, value.species)
+    elif hasattr(value, "adj"):  # A networkx graph, compiled as the model would
+        network = ContactNetwork.from_graph(value)
+        value = (network.indptr, network.indices, network.species)
+
+    if isinstance(value, (list, tuple)):
+        return tuple(canonical(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, canonical(item)) for key, item in value.items()))
+    if isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        return "ndarray", str(value.dtype), value.shape, hashlib.sha256(value.tobytes()).hexdigest()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class BurnInCache:
+
+    def __init__(self, directory, max_bytes=2 ** 30):
+        """
+        Checkpoints of models that have been run for their burn in, one .npz file per set of arguments.
+        When the files take up more than max_bytes, the least recently used ones are deleted.
+
+        The key is made from every constructor argument, including the seed and replicate, and the number of
+        burn in steps. It does not cover the model code, so clear the cache after changing how the model works.
+
+        Args:
+            directory: Directory to keep the checkpoints in. Made if it does not exist.
+            max_bytes: Disk budget of the cache.
+        """
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def key(self, model_cls, kwargs, burn_in_steps):
+        """Returns the hex digest that names the checkpoint of a model after burn_in_steps steps."""
+
+        arguments = inspect.signature(model_cls).bind(**kwargs)
+        arguments.apply_defaults()  # Leaving out a default and passing it give the same key
+        identity = (KEY_VERSION, model_cls.__module__, model_cls.__qualname__, burn_in_steps,
+                    canonical(dict(arguments.arguments)))
+        return hashlib.sha256(pickle.dumps(identity)).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def get_model(self, model_cls, kwargs, burn_in_steps):
+        """
+        Returns a model made with kwargs that has run burn_in_steps steps, loaded from the cache if it is there.
+        Otherwise the model is made, burned in and cached. Data collected during the burn in is dropped either way,
+        so the model's collector starts at the end of the burn in.
+
+        Args:
+            model_cls: The model class to run.
+            kwargs: Keyword arguments to make the model with.
+            burn_in_steps: Number of steps to run before collecting.
+        """
+
+        path = self.path(self.key(model_cls, kwargs, burn_in_steps))
+        try:
+            model = model_cls.load_checkpoint(path)
+        except (OSError, ValueError, EOFError, KeyError):  # Not cached, or a broken file
+            model = None
+        if model is not None:
+            try:
+                os.utime(path)  # Most recently used
+            except OSError:  # Evicted by another process since it was loaded
+                pass
+            return model
+
+        model = model_cls(**kwargs)
+        while model.running and model.schedule.steps < burn_in_steps:
+            model.step()
+        model.datacollector.clear()
+
+        # Saved under a name of its own and moved into place, so other processes never load half a file.
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp.npz"
+        model.save_checkpoint(temp_path)
+        os.replace(temp_path, path)
+        self.evict()
+
+        # Go on from the checkpoint, so a model gives the same results whether it was cached or not.
+        try:
+            return model_cls.load_checkpoint(path)
+        except OSError:  # Evicted by another process in the meantime
+            pass
+
+        # Saving and loading again puts the model in the state a cached one starts from.
+        model.save_checkpoint(temp_path)
+        try:
+            return model_cls.load_checkpoint(temp_path)
+        finally:
+            os.remove(temp_path)
+
+    def evict(self):
+        """Deletes the least recently used checkpoints until the cache fits in max_bytes."""
+
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz") and ".tmp." not in name:
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:  # Deleted by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries)[:-1]:  # Never the newest, which was just used
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Deletes every checkpoint in the cache."""
+
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz"):
+                os.remove(os.path.join(self.directory, name))
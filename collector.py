@@ -0,0 +1,184 @@
+"""
+Data collection for VirusModel. Records how many hosts of each species carry each virus every step.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def strain_names(num_H, num_N):
+    """Returns the column name of each virus, in the order of a flattened num_H x num_N matrix."""
+
+    return [f"H{i + 1}N{j + 1}" for i in range(num_H) for j in range(num_N)]
+
+
+class StrainCollector:
+
+    def __init__(self, species, agent_interval=None):
+        """
+        Collects a steps x species x NUM_H x NUM_N array of strain counts, one reduction of the
+        population state per step, instead of reading one attribute per virus from every agent.
+
+        It can be used in place of a mesa DataCollector, so BatchRunner still picks up its data
+        through get_agent_vars_dataframe.
+
+        Args:
+            species: Names of the species, in species id order.
+            agent_interval: If set, also record every host's viruses every agent_interval steps.
+        """
+
+        self.species = list(species)
+        self.agent_interval = agent_interval
+
+        self.steps = []  # Step number of each collected entry
+        self.iterations = []  # Iteration of the model at each collected entry
+        self.strain_counts = []  # Species x NUM_H x NUM_N count array of each collected entry
+
+        # Per agent snapshots. Each entry is (step, iteration, host ids, species ids, viruses).
+        self.agent_snapshots = []
+
+        # A StrainWriter to stream counts to instead of keeping them, and the path it wrote once closed.
+        self.writer = None
+        self.output_path = None
+
+        # The model's StageProfiler when it is profiled, so its timings go back with the results.
+        self.profiler = None
+
+        # Read by mesa's BatchRunner to decide which dataframes to get.
+        self.model_reporters = None
+        self.agent_reporters = {}
+
+    def collect(self, model):
+        """Records the strain counts of the model's current state."""
+
+        step = model.schedule.steps
+        if self.writer is not None:
+            self.writer.write(step, model.it, model.strain_counts())
+        else:
+            self.steps.append(step)
+            self.iterations.append(model.it)
+            self.strain_counts.append(model.strain_counts())
+
+        if self.agent_interval and step % self.agent_interval == 0:
+            self.agent_snapshots.append((step, model.it) + model.host_states())
+
+    def get_state(self):
+        """Returns a dictionary of arrays with everything collected so far, for checkpoints."""
+
+        snapshots = self.agent_snapshots
+        return {
+            "steps": np.array(self.steps, dtype=np.int64),
+            "iterations": np.array(self.iterations, dtype=np.int64),
+            "strain_counts": self.counts,
+            "snapshot_steps": np.array([snapshot[0] for snapshot in snapshots], dtype=np.int64),
+            "snapshot_iterations": np.array([snapshot[1] for snapshot in snapshots], dtype=np.int64),
+            "snapshot_sizes": np.array([len(snapshot[2]) for snapshot in snapshots], dtype=np.int64),
+            "snapshot_ids": np.concatenate([snapshot[2] for snapshot in snapshots]) if snapshots else np.zeros(0),
+            "snapshot_species": np.concatenate([snapshot[3] for snapshot in snapshots]) if snapshots else np.zeros(0),
+            "snapshot_viruses": np.concatenate([snapshot[4] for snapshot in snapshots]) if snapshots else np.zeros(0),
+        }
+
+    def set_state(self, state):
+        """Replaces everything collected with the state returned by get_state."""
+
+        self.steps = state["steps"].tolist()
+        self.iterations = state["iterations"].tolist()
+        self.strain_counts = list(state["strain_counts"])
+
+        bounds = np.cumsum(state["snapshot_sizes"])[:-1]
+        self.agent_snapshots = list(zip(state["snapshot_steps"].tolist(), state["snapshot_iterations"].tolist(),
+                                        np.split(state["snapshot_ids"], bounds),
+                                        np.split(state["snapshot_species"], bounds),
+                                        np.split(state["snapshot_viruses"], bounds)))
+
+    def clear(self):
+        """Drops everything collected so far, such as the steps of a burn in."""
+
+        self.steps = []
+        self.iterations = []
+        self.strain_counts = []
+        self.agent_snapshots = []
+
+    def stream(self, writer):
+        """
+        Streams the strain counts of every later step to a StrainWriter instead of keeping them in memory.
+        What was collected before is written first.
+        """
+
+        for step, iteration, counts in zip(self.steps, self.iterations, self.strain_counts):
+            writer.write(step, iteration, counts)
+        self.steps = []
+        self.iterations = []
+        self.strain_counts = []
+        self.writer = writer
+        self.output_path = None
+
+    def close(self):
+        """
+        Writes what the writer still buffers and detaches it, so the collector can be pickled back
+        from a worker process. get_agent_vars_dataframe then reads the written output.
+        """
+
+        if self.writer is None:
+            return
+        self.writer.close()
+        self.output_path = self.writer.path
+        self.writer = None
+
+    @property
+    def counts(self):
+        """The steps x species x NUM_H x NUM_N array of everything collected so far."""
+
+        if self.output_path is not None:
+            frame = self.get_agent_vars_dataframe()
+            num_H, num_N = map(int, frame.columns[-1][1:].split("N"))  # The last column is the last virus
+            return frame.to_numpy().reshape(-1, len(self.species), num_H, num_N)
+        if not self.strain_counts:
+            return np.zeros((0, len(self.species), 0, 0), dtype=np.int64)
+        return np.stack(self.strain_counts)
+
+    def strain_names(self):
+        """Returns the column name of each virus, in the order of a flattened NUM_H x NUM_N matrix."""
+
+        _, _, num_H, num_N = self.counts.shape
+        return strain_names(num_H, num_N)
+
+    def get_agent_vars_dataframe(self):
+        """
+        Returns the number of hosts infected by each virus, with one row per step and species,
+        indexed by Step, Iteration and Species.
+
+        This is what grouping the old per agent data by Step, Iteration and Species and summing gave.
+        Counts streamed to a StrainWriter are read back from its output once the collector is closed.
+        """
+
+        if self.output_path is not None:
+            from writer import read_strain_counts  # The writer module imports this one
+            return read_strain_counts(self.output_path)
+
+        counts = self.counts
+        index = pd.MultiIndex.from_arrays(
+            [np.repeat(self.steps, len(self.species)),
+             np.repeat(self.iterations, len(self.species)),
+             np.tile(self.species, len(self.steps))],
+            names=["Step", "Iteration", "Species"])
+        return pd.DataFrame(counts.reshape(len(counts) * len(self.species), -1),
+                            index=index, columns=self.strain_names())
+
+    def get_agent_snapshots_dataframe(self):
+        """
+        Returns the viruses of every host at each snapshot, with one row per host,
+        indexed by Step and AgentID like a mesa DataCollector's agent dataframe.
+        """
+
+        frames = []
+        for step, iteration, ids, species, viruses in self.agent_snapshots:
+            frame = pd.DataFrame(viruses.reshape(len(ids), -1).astype(int), columns=self.strain_names())
+            frame.insert(0, "Species", np.asarray(self.species)[species])
+            frame.insert(0, "Iteration", iteration)
+            frame.index = pd.MultiIndex.from_arrays([np.full(len(ids), step), ids], names=["Step", "AgentID"])
+            frames.append(frame)
+
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames)
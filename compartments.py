@@ -0,0 +1,360 @@
+"""
+Compartment engine of VirusModel. Hosts in the same state are lumped together, so memory and
+time depend on the number of distinct states instead of the number of hosts.
+"""
+
+import numpy as np
+
+from model import NUM_H, NUM_N, SPECIES, Population, draw_events
+
+# Fields of a state and their width in bits, packed into one integer key from the lowest bits up.
+# H and N are the proteins of the viruses the hosts carry, which after recombining are every pairing
+# of them. immune_H and immune_N are the proteins the hosts are immune to.
+FIELDS = [("species", 2), ("H", NUM_H), ("N", NUM_N), ("immune_H", NUM_H), ("immune_N", NUM_N)]
+
+H_BITS = np.arange(NUM_H)
+N_BITS = np.arange(NUM_N)
+
+
+def encode(species, H, N, immune_H, immune_N):
+    """Packs the fields of states into uint64 keys."""
+
+    key = np.zeros(np.shape(species), dtype=np.uint64)
+    shift = 0
+    for (_, width), value in zip(FIELDS, [species, H, N, immune_H, immune_N]):
+        key |= np.asarray(value, dtype=np.uint64) << np.uint64(shift)
+        shift += width
+    return key
+
+
+def decode(keys):
+    """Unpacks uint64 keys into arrays of species, H, N, immune_H and immune_N."""
+
+    fields = []
+    shift = 0
+    for _, width in FIELDS:
+        fields.append(((keys >> np.uint64(shift)) & np.uint64((1 << width) - 1)).astype(np.int64))
+        shift += width
+    return fields
+
+
+def unpack_masks(masks, bits):
+    """Turns an array of bit masks into a boolean array with one column per bit."""
+
+    return (masks[:, np.newaxis] >> bits) & 1 > 0
+
+
+def pack_masks(flags):
+    """Turns a boolean array with one column per bit back into an array of bit masks."""
+
+    return flags.astype(np.int64) @ (1 << np.arange(flags.shape[1], dtype=np.int64))
+
+
+class CompartmentPopulation:
+
+    # Same per host rates as Host.
+    mutation_prob = Population.mutation_prob
+    recovery_prob = Population.recovery_prob
+    death_rate = Population.death_rate
+    death_rate_factors = Population.death_rate_factors
+
+    # States with up to this many hosts have their contacts drawn one host at a time, larger ones all at once.
+    expand_max_hosts = 64
+
+    # Upper bound on the number of virus matrix entries made at once in contract_virus, as in Population.
+    chunk_size = Population.chunk_size
+
+    def __init__(self, model, species, viruses=None):
+        """
+        Every host of a model lumped into compartments, the number of hosts in each distinct state.
+        A state is the species, the H and N proteins of the viruses carried and the H and N proteins
+        the host is immune to, packed into one key with encode. Most hosts are in one of a few states,
+        uninfected and not immune, so only the occupied states are kept.
+
+        Each stage moves hosts between states by binomial draws on the number of hosts in each state,
+        with the same per host probabilities as Population. Only contacts with an infected host are drawn,
+        and each of them picks its source from the infected states by how many hosts are in them.
+        Transmission is decided per contact, so the contact and binomial transmission modes are the same here.
+
+        Hosts are lumped by their recombined viruses, every pairing of the H and N proteins they carry,
+        which is what every engine holds after its first recombine stage.
+
+        Args:
+            model: The model the population is a part of
+            species: Array with the species id of each host.
+            viruses: num_hosts x NUM_H x NUM_N array of the viruses each host starts with. Defaults to none.
+        """
+
+        self.model = model
+        species = np.asarray(species, dtype=np.int64)
+        if viruses is None:
+            viruses = np.zeros((len(species), NUM_H, NUM_N), dtype=bool)
+        viruses = np.asarray(viruses).reshape(-1, NUM_H, NUM_N) > 0
+
+        self.sizes = np.bincount(species, minlength=len(SPECIES))  # Number of hosts of each species
+        self.keys = np.zeros(0, dtype=np.uint64)  # Key of each occupied state
+        self.counts = np.zeros(0, dtype=np.int64)  # Number of hosts in each state
+        self.add(encode(species, pack_masks(viruses.any(axis=2)), pack_masks(viruses.any(axis=1)), 0, 0),
+                 np.ones(len(species), dtype=np.int64))
+
+    @classmethod
+    def random(cls, model, num_hosts, virus_prob):
+        """
+        Makes a random initial population like Population.random, without drawing anything per uninfected host.
+        The number of hosts of each species and of infected hosts is drawn first, then only the
+        infected hosts get their viruses drawn.
+        """
+
+        rng = model.rng
+        sizes = rng.multinomial(num_hosts, np.full(len(SPECIES), 1 / len(SPECIES)))
+        num_infected = rng.binomial(sizes, 1 - (1 - virus_prob) ** (NUM_H * NUM_N))
+        num_uninfected = sizes - num_infected
+
+        # The first virus of an infected host follows a geometric distribution cut off at the last virus,
+        # and each virus after it is carried with probability virus_prob.
+        first_prob = virus_prob * (1 - virus_prob) ** np.arange(NUM_H * NUM_N)
+        first = rng.choice(NUM_H * NUM_N, size=num_infected.sum(), p=first_prob / first_prob.sum())
+        viruses = rng.random((len(first), NUM_H * NUM_N)) < virus_prob
+        viruses[np.arange(NUM_H * NUM_N) < first[:, np.newaxis]] = False
+        viruses[np.arange(len(first)), first] = True
+
+        population = cls(model, np.repeat(np.arange(len(SPECIES)), num_infected), viruses)
+        population.sizes += num_uninfected
+        population.add(encode(np.arange(len(SPECIES)), 0, 0, 0, 0), num_uninfected)
+        return population
+
+    @classmethod
+    def from_state(cls, model, state):
+        """Makes a population with the state returned by get_state."""
+
+        population = cls(model, [])
+        population.sizes = state["sizes"]
+        population.keys = state["keys"]
+        population.counts = state["counts"]
+        return population
+
+    def get_state(self):
+        """Returns a dictionary of the arrays that make up the population between steps, for checkpoints."""
+
+        return {"sizes": self.sizes, "keys": self.keys, "counts": self.counts}
+
+    def __len__(self):
+        return int(self.sizes.sum())
+
+    def add(self, keys, counts):
+        """Adds counts hosts to the states with the given keys, and merges states with the same key."""
+
+        keys, index = np.unique(np.concatenate([self.keys, keys]), return_inverse=True)
+        counts = np.bincount(index, weights=np.concatenate([self.counts, counts]), minlength=len(keys))
+        occupied = counts > 0
+        self.keys = keys[occupied]
+        self.counts = counts[occupied].astype(np.int64)
+
+    def move(self, states, keys):
+        """Moves one host out of each of the states into the state with the matching key."""
+
+        np.subtract.at(self.counts, states, 1)
+        self.add(keys, np.ones(len(keys), dtype=np.int64))
+
+    def move_counts(self, counts, keys):
+        """Moves counts[s] hosts out of every state s, into the state keys[s]."""
+
+        self.counts = self.counts - counts
+        self.add(keys, counts)
+
+    def step(self):
+        """Runs every stage once over all compartments, in the same order as the agent schedule."""
+
+        with self.model.stage("contract_virus", len(self)):
+            self.contract_virus()
+        with self.model.stage("recombine", len(self)):
+            self.mutate()
+        with self.model.stage("recover", len(self)):
+            self.recover()
+        with self.model.stage("birth_death", len(self)):
+            self.birth_death()
+
+    def contract_virus(self):
+        """
+        STAGE 1
+        Every host contacts int(sizes[j] * contact_rates[i][j]) random hosts of each species j.
+        Only the contacts that reach an infected host are drawn, in batches of about chunk_size / (NUM_H * NUM_N),
+        so memory depends on the number of states and not on the number of contacts. Hosts that got a virus
+        move to the state with their recombined viruses.
+        """
+
+        rng = self.model.rng
+        species, H, N, immune_H, immune_N = decode(self.keys)
+        infected = H != 0
+        num_infected = np.bincount(species[infected], weights=self.counts[infected], minlength=len(SPECIES))
+        if not num_infected.any():
+            return
+        infected_fraction = np.divide(num_infected, self.sizes, out=np.zeros(len(SPECIES)), where=self.sizes > 0)
+
+        # Contacts a host of species i makes with species j per step, the same as in draw_contacts
+        contacts = np.floor(self.sizes[np.newaxis, :] * np.reshape(self.model.contact_rates, (len(SPECIES), len(SPECIES))))
+        contacts = contacts.astype(np.int64)[species]
+
+        # The infected states of each species, and the running total of their hosts to pick contacts from.
+        infected_states = [np.flatnonzero(infected & (species == j)) for j in range(len(SPECIES))]
+        cumulative = [np.cumsum(self.counts[states]) for states in infected_states]
+
+        # Each host is numbered within its state, and got_H and got_N hold what the hosts that were reached got.
+        host_keys, got_H, got_N = [], [], []
+        step = max(1, self.chunk_size // (NUM_H * NUM_N))
+        for states, receivers, source_species in self.infectious_contacts(contacts, infected_fraction, step):
+
+            # The infected host contacted, picked by the number of hosts in each infected state of its species.
+            sources = np.zeros(len(states), dtype=np.int64)
+            for j in range(len(SPECIES)):
+                contacted = source_species == j
+                if contacted.any():
+                    picks = rng.integers(cumulative[j][-1], size=np.count_nonzero(contacted))
+                    sources[contacted] = infected_states[j][np.searchsorted(cumulative[j], picks, side="right")]
+
+            # Every virus the contact carries is passed on with its probability in the model's transmission_table.
+            transmitted = (unpack_masks(H[sources], H_BITS)[:, :, np.newaxis] &
+                           unpack_masks(N[sources], N_BITS)[:, np.newaxis, :])
+            contact, row, column = np.nonzero(transmitted)
+            probabilities = self.model.transmission_table[species[states[contact]], source_species[contact], row, column]
+            transmitted[contact, row, column] = rng.random(len(contact)) < probabilities
+
+            # Keep the viruses the host is susceptible to.
+            transmitted &= ~(unpack_masks(immune_H[states], H_BITS)[:, :, np.newaxis] |
+                             unpack_masks(immune_N[states], N_BITS)[:, np.newaxis, :])
+
+            # Combine what each host of the batch got from all its contacts in it.
+            keys, index = np.unique(states * self.counts.max() + receivers, return_inverse=True)
+            host_keys.append(keys)
+            got_H.append(np.zeros(len(keys), dtype=np.int64))
+            got_N.append(np.zeros(len(keys), dtype=np.int64))
+            np.bitwise_or.at(got_H[-1], index, pack_masks(transmitted.any(axis=2)))
+            np.bitwise_or.at(got_N[-1], index, pack_masks(transmitted.any(axis=1)))
+
+        if not host_keys:
+            return
+
+        # Then over the batches, as a host's contacts can fall in more than one.
+        hosts, index = np.unique(np.concatenate(host_keys), return_inverse=True)
+        host_H = np.zeros(len(hosts), dtype=np.int64)
+        host_N = np.zeros(len(hosts), dtype=np.int64)
+        np.bitwise_or.at(host_H, index, np.concatenate(got_H))
+        np.bitwise_or.at(host_N, index, np.concatenate(got_N))
+
+        infections = host_H != 0
+        moved = hosts[infections] // self.counts.max()
+        self.move(moved, encode(species[moved], H[moved] | host_H[infections], N[moved] | host_N[infections],
+                                immune_H[moved], immune_N[moved]))
+
+    def infectious_contacts(self, contacts, infected_fraction, step):
+        """
+        Yields the contacts of this step that reach an infected host, about step at a time, as arrays of
+        the state of the host making each contact, the number of that host within its state and the species it reaches.
+
+        Args:
+            contacts: States x species array of the number of contacts each host of a state makes with each species.
+            infected_fraction: Fraction of the hosts of each species that are infected.
+            step: Number of contacts to yield at a time.
+        """
+
+        rng = self.model.rng
+
+        # Small states are drawn host by host: the number of each host's contacts that reach an infected host.
+        small = np.flatnonzero(self.counts <= self.expand_max_hosts)
+        host_states = np.repeat(small, self.counts[small])
+        first_hosts = np.cumsum(self.counts[small]) - self.counts[small]
+        host_numbers = np.arange(len(host_states)) - np.repeat(first_hosts, self.counts[small])
+        block = max(1, int(step // max(1, (contacts[small] * infected_fraction).sum(axis=1).max(initial=0))))
+        for start in range(0, len(host_states), block):
+            states, numbers = host_states[start:start + block], host_numbers[start:start + block]
+            per_host = rng.binomial(contacts[states], infected_fraction[np.newaxis, :])
+            made = np.repeat(np.arange(per_host.size), per_host.reshape(-1))
+            if len(made):
+                yield states[made // len(SPECIES)], numbers[made // len(SPECIES)], made % len(SPECIES)
+
+        # Large states draw which of the counts[s] * contacts[s, j] contacts of the state reach an infected host
+        # of species j, a segment of them at a time. The number of a contact says which host of the state made it.
+        for s in np.flatnonzero(self.counts > self.expand_max_hosts):
+            for j in np.flatnonzero(infected_fraction):
+                num_slots = int(self.counts[s] * contacts[s, j])
+                segment = max(1, int(step / infected_fraction[j]))
+                for first in range(0, num_slots, segment):
+                    slots = first + draw_events(min(segment, num_slots - first), infected_fraction[j], rng)
+                    if len(slots):
+                        yield np.full(len(slots), s), slots // contacts[s, j], np.full(len(slots), j)
+
+    def mutate(self):
+        """
+        STAGE 2
+        Each infected host has a chance of gaining a new H or N protein. See Host.mutate.
+        Viruses are already recombined when hosts move between states.
+        """
+
+        rng = self.model.rng
+        species, H, N, immune_H, immune_N = decode(self.keys)
+        num_mutants = rng.binomial(self.counts, self.mutation_prob)
+        num_mutants[H == 0] = 0  # Uninfected hosts throw away the mutant
+        mutants = np.repeat(np.arange(len(self.keys)), num_mutants)
+
+        new_H = H[mutants]
+        new_N = N[mutants]
+        on_H = rng.random(len(mutants)) < .5  # Equal chance to mutate into H or N
+        new_H[on_H] |= 1 << rng.integers(NUM_H, size=np.count_nonzero(on_H))
+        new_N[~on_H] |= 1 << rng.integers(NUM_N, size=np.count_nonzero(~on_H))
+        self.move(mutants, encode(species[mutants], new_H, new_N, immune_H[mutants], immune_N[mutants]))
+
+    def recover(self):
+        """
+        STAGE 3
+        Hosts that recover lose all current viruses and become immune to those of that type.
+        """
+
+        species, H, N, _, _ = decode(self.keys)
+        recovered = self.model.rng.binomial(self.counts, self.recovery_prob)
+        self.move_counts(recovered, encode(species, 0, 0, H, N))
+
+    def birth_death(self):
+        """
+        STAGE 4
+        Hosts that die are replaced by a new host of the same species.
+        """
+
+        species = decode(self.keys)[0]
+        died = self.model.rng.binomial(self.counts, self.death_rate * self.death_rate_factors[species])
+        self.move_counts(died, encode(species, 0, 0, 0, 0))
+
+    def immigrate(self, p):
+        """
+        STAGE 5
+        Immigrants arrive, with probability p for each host. See VirusModel.immigrate.
+        Replacing immigrants take the place of random hosts of their species, whatever state they are in.
+        """
+
+        rng = self.model.rng
+        arrivals = rng.binomial(self.sizes, p)
+        if self.model.immigration == "replace":
+            species = decode(self.keys)[0]
+            leaving = np.zeros(len(self.keys), dtype=np.int64)
+            for i in np.flatnonzero(arrivals):
+                states = np.flatnonzero(species == i)
+                leaving[states] = rng.multivariate_hypergeometric(self.counts[states], arrivals[i])
+            self.counts = self.counts - leaving
+        else:
+            self.sizes = self.sizes + arrivals
+
+        # Immigrants are lumped by their recombined viruses, like every other host.
+        species = np.repeat(np.arange(len(SPECIES)), arrivals)
+        viruses = self.model.immigrant_viruses(species)
+        keys = encode(species, pack_masks(viruses.any(axis=2)), pack_masks(viruses.any(axis=1)), 0, 0)
+        self.add(keys, np.ones(len(keys), dtype=np.int64))
+
+    def strain_counts(self):
+        """Returns a species x NUM_H x NUM_N array with the number of hosts infected by each virus."""
+
+        species, H, N, _, _ = decode(self.keys)
+        counts = np.zeros((len(SPECIES), NUM_H, NUM_N), dtype=np.int64)
+        for i in range(len(SPECIES)):
+            states = (species == i) & (H != 0)
+            viruses = unpack_masks(H[states], H_BITS)[:, :, np.newaxis] & unpack_masks(N[states], N_BITS)[:, np.newaxis, :]
+            counts[i] = np.tensordot(self.counts[states], viruses, axes=1)
+        return counts
@@ -0,0 +1,269 @@
+"""
+Event driven engine of VirusModel. Instead of rolling dice for every host and process each step,
+infections, mutations, recoveries and deaths happen as events drawn from their rates (Gillespie's algorithm).
+"""
+
+import numpy as np
+
+from model import NUM_H, NUM_N, SPECIES, IndexSet, Population
+
+
+def event_rate(p):
+    """Returns the rate of an event that happens with probability p per step."""
+
+    return -np.log1p(-p)
+
+
+class EventPopulation(Population):
+
+    # Populations up to this size are simulated event by event. Larger ones take tau leaps.
+    exact_max_hosts = 10 ** 4
+
+    # A tau leap is sized so that about this fraction of the infected or immune hosts has an event in it.
+    leap_epsilon = 0.03
+
+    def __init__(self, model, species, viruses=None, capacity=None):
+        """
+        A Population that moves forward in continuous time by drawing events from their rates,
+        instead of running every stage over every host each step.
+
+        Each per step probability p of the stepping engines becomes a rate -log(1 - p), so an event
+        still happens to a host within a step with probability p. Contacts become events too. A host of
+        species i contacts the same int(len(pools[j]) * contact_rates[i][j]) hosts of species j per step
+        on average, but only contacts with an infected host are drawn, as the rest cannot pass anything on.
+        Transmission is decided per contact, so the contact and binomial transmission modes are the same here.
+        As in the stepping engines, only hosts infected at the start of a step pass viruses on during it.
+        Otherwise infections would chain within the step, and at 2e4 hosts one step infected about ten
+        times as many hosts as the vectorized engine.
+
+        Events that cannot change anything are never drawn either. Uninfected hosts cannot mutate, and
+        recovery or death only changes hosts that are infected or immune. The infected and immune hosts
+        of each species are kept in IndexSets, so the work done in a step depends on the number of
+        events and not the number of hosts.
+
+        Args:
+            model: The model the population is a part of
+            species: Array with the species id of each host.
+            viruses: num_hosts x NUM_H x NUM_N array of the viruses each host starts with. Defaults to none.
+            capacity: Number of rows to make room for, see Population.
+        """
+
+        # Hosts that are infected or immune, of each species. Population keeps the infected ones,
+        # and fills both through refresh.
+        self.affected = [IndexSet(max(len(species), capacity or 0)) for _ in SPECIES]
+        super().__init__(model, species, viruses, capacity)
+
+        # Each kind of event, as the method that applies it and the arguments before the number of events.
+        # Their rates are worked out in the same order by rates.
+        self.channels = ([(self.infect, (i, j)) for i in range(len(SPECIES)) for j in range(len(SPECIES))] +
+                         [(self.mutate_hosts, ()), (self.recover_hosts, ())] +
+                         [(self.kill_hosts, (i,)) for i in range(len(SPECIES))])
+
+        self.events = 0  # Number of events in the last step
+        self.sources = self.infected_hosts()  # Hosts that can pass viruses on in this step, of each species
+
+    @classmethod
+    def from_state(cls, model, state):
+        """Makes a population with the state returned by get_state."""
+
+        population = super().from_state(model, state)
+        for hosts, members in zip(population.affected, np.split(state["affected"], np.cumsum(state["affected_sizes"])[:-1])):
+            hosts.reset(members)
+        return population
+
+    def get_state(self):
+        """Returns the state of Population.get_state, with the affected sets as well."""
+
+        state = super().get_state()
+        state["affected"] = np.concatenate([hosts.members[:len(hosts)] for hosts in self.affected])
+        state["affected_sizes"] = np.array([len(hosts) for hosts in self.affected])
+        return state
+
+    def index_sets(self):
+        """Returns the IndexSets of Population.index_sets and the affected sets."""
+
+        return super().index_sets() + self.affected
+
+    def refresh(self, hosts):
+        """Updates the infected and affected sets, and the active proteins, of hosts whose state changed."""
+
+        super().refresh(hosts)
+        if len(hosts) > 1:
+            hosts = np.unique(hosts)
+        affected = self.viruses[hosts].any(axis=(1, 2)) | ~self.susceptibility[hosts].all(axis=(1, 2))
+        if len(hosts) == 1:  # Most events change one host
+            self.affected[self.species[hosts[0]]].update(hosts, affected)
+            return
+
+        for i in range(len(SPECIES)):
+            of_species = self.species[hosts] == i
+            self.affected[i].update(hosts[of_species], affected[of_species])
+
+    def infected_hosts(self):
+        """Returns an array of the infected hosts of each species."""
+
+        return [hosts.members[:len(hosts)].copy() for hosts in self.infected]
+
+    def rate_factors(self):
+        """
+        Returns the rate of each channel per host it can happen to, in the order of self.channels.
+        Multiplied by the counts of rates, this gives the total rate of each channel.
+
+        The infection channel of species i and j is the rate at which hosts of species i contact
+        one infected host of species j.
+        """
+
+        sizes = np.array([len(hosts) for hosts in self.pools])
+
+        # Contacts a host of species i makes with species j per step, the same as in draw_contacts
+        contacts = np.floor(sizes[np.newaxis, :] * np.reshape(self.model.contact_rates, (len(SPECIES), len(SPECIES))))
+        infection = np.divide(sizes[:, np.newaxis] * contacts, sizes[np.newaxis, :],
+                              out=np.zeros(contacts.shape), where=sizes[np.newaxis, :] > 0)
+
+        return np.concatenate([infection.reshape(-1),
+                               [event_rate(self.mutation_prob), event_rate(self.recovery_prob)],
+                               event_rate(self.death_rate * self.death_rate_factors)])
+
+    def rates(self, factors):
+        """Returns the total rate of each channel, given the rate_factors."""
+
+        sources = [len(hosts) for hosts in self.sources]
+        infected = [len(hosts) for hosts in self.infected]
+        affected = [len(hosts) for hosts in self.affected]
+        return factors * np.array(sources * len(SPECIES) + [sum(infected), sum(affected)] + affected)
+
+    def step(self):
+        """Moves the population forward by one step of time."""
+
+        with self.model.stage("events", len(self)):
+            self.events = 0
+            self.sources = self.infected_hosts()
+            if len(self) <= self.exact_max_hosts:
+                self.simulate_exact(1)
+            else:
+                self.simulate_leaps(1)
+
+    def simulate_exact(self, duration):
+        """Runs events one at a time for duration steps, with the direct method of the SSA."""
+
+        rng = self.model.rng
+        factors = self.rate_factors()
+        time = 0
+        while True:
+            rates = self.rates(factors)
+            total = rates.sum()
+            if total <= 0:
+                break
+            time += rng.exponential(1 / total)
+            if time >= duration:
+                break
+            channel = min(np.searchsorted(np.cumsum(rates), rng.random() * total, side="right"), len(rates) - 1)
+            self.fire(channel, 1)
+
+    def simulate_leaps(self, duration):
+        """
+        Runs duration steps in tau leaps. Each leap draws a Poisson number of events of every channel at once,
+        and is short enough that about leap_epsilon of the affected hosts have an event in it.
+        """
+
+        rng = self.model.rng
+        factors = self.rate_factors()
+        time = 0
+        while time < duration:
+            rates = self.rates(factors)
+            total = rates.sum()
+            if total <= 0:
+                break
+            affected = sum(len(hosts) for hosts in self.affected)
+            tau = min(duration - time, self.leap_epsilon * max(affected, 1) / total)
+            counts = rng.poisson(rates * tau)
+            for channel in np.flatnonzero(counts):
+                self.fire(channel, counts[channel])
+            time += tau
+
+    def fire(self, channel, n):
+        """Applies n events of a channel."""
+
+        function, args = self.channels[channel]
+        self.refresh(function(*args, n))
+        self.events += n
+
+    def sample_hosts(self, sets, n, replace=True):
+        """Returns n random hosts from the union of a list of IndexSets."""
+
+        sizes = np.array([len(hosts) for hosts in sets])
+        rng = self.model.rng
+        if replace:
+            counts = rng.multinomial(n, sizes / sizes.sum())
+        else:
+            counts = rng.multivariate_hypergeometric(sizes, min(n, sizes.sum()))
+        return np.concatenate([hosts.sample(count, rng, replace) for hosts, count in zip(sets, counts)])
+
+    def recombine_hosts(self, hosts):
+        """All viruses within each host recombine, as in Population.recombine."""
+
+        self.H[hosts] = self.viruses[hosts].any(axis=2)
+        self.N[hosts] = self.viruses[hosts].any(axis=1)
+        self.viruses[hosts] = self.H[hosts, :, np.newaxis] & self.N[hosts, np.newaxis, :]
+
+    def infect(self, i, j, n):
+        """
+        n hosts of species i each contact one of the sources of species j.
+        Every virus the contact carries is passed on with its probability in the model's transmission_table.
+        """
+
+        rng = self.model.rng
+        sources = self.sources[j][rng.integers(len(self.sources[j]), size=n)]
+        receivers = self.pools[i][rng.integers(len(self.pools[i]), size=n)]
+
+        transmitted = self.viruses[sources]
+        probabilities = np.broadcast_to(self.model.transmission_table[i, j], transmitted.shape)
+        transmitted[transmitted] = rng.random(np.count_nonzero(transmitted)) < probabilities[transmitted]
+
+        # Keep the viruses the host is susceptible to.
+        transmitted &= self.susceptibility[receivers]
+
+        # A receiver contacted more than once gets the viruses of every contact. Repeats are few,
+        # so one occurrence of each receiver is added at a time.
+        remaining, remaining_transmitted = receivers, transmitted
+        while len(remaining):
+            hosts, first = np.unique(remaining, return_index=True)
+            self.viruses[hosts] |= remaining_transmitted[first]
+            repeats = np.ones(len(remaining), dtype=bool)
+            repeats[first] = False
+            remaining, remaining_transmitted = remaining[repeats], remaining_transmitted[repeats]
+
+        receivers = np.unique(receivers)
+        self.recombine_hosts(receivers)
+        return receivers
+
+    def mutate_hosts(self, n):
+        """n infected hosts gain a new H or N protein. See Host.mutate."""
+
+        rng = self.model.rng
+        mutants = self.sample_hosts(self.infected, n)
+        on_H = rng.random(len(mutants)) < .5  # Equal chance to mutate into H or N
+        self.H[mutants[on_H], rng.integers(NUM_H, size=np.count_nonzero(on_H))] = True
+        self.N[mutants[~on_H], rng.integers(NUM_N, size=np.count_nonzero(~on_H))] = True
+        self.viruses[mutants] = self.H[mutants, :, np.newaxis] & self.N[mutants, np.newaxis, :]
+        return mutants
+
+    def recover_hosts(self, n):
+        """n hosts lose all current viruses and become immune to those of that type."""
+
+        recovered = self.sample_hosts(self.affected, n, replace=False)
+        self.susceptibility[recovered] = ~(self.H[recovered, :, np.newaxis] | self.N[recovered, np.newaxis, :])
+        self.viruses[recovered] = False
+        self.H[recovered] = False
+        self.N[recovered] = False
+        return recovered
+
+    def kill_hosts(self, i, n):
+        """n hosts of species i die and are replaced by a new host of the same species."""
+
+        died = self.affected[i].sample(n, self.model.rng, replace=False)
+        self.viruses[died] = False
+        self.susceptibility[died] = True
+        self.H[died] = False
+        self.N[died] = False
+        return died
@@ -2,17 +2,19 @@
 The agent and simulation class live here.
 """
 
+
+import functools
 import json
-import random
+from operator import attrgetter
 
 import numpy as np
 from mesa import Agent, Model
-from mesa.datacollection import DataCollector
 from mesa.time import StagedActivation
 
 
-from parameters import infection_table
-from parameters import viruses as all_viruses
+from collector import StrainCollector
+from profiling import NOT_PROFILED, ProfiledStagedActivation, StageProfiler
+from parameters import infection_table, transmission_fitness
 
 
 NUM_H = 17  # Number of rows
@@ -22,15 +24,123 @@ NUM_N = 10  # Number of columns
 ONES = np.ones([NUM_H, NUM_N])
 ZEROS = np.zeros([NUM_H, NUM_N])
 
-# Random number generator
-rng = np.random.default_rng(seed=2021)
+# Read only state shared by every Host that has no viruses or immunity. Hosts replace them instead of writing to them.
+NO_VIRUSES = np.zeros([NUM_H, NUM_N], dtype=bool)
+NO_H = np.zeros(NUM_H, dtype=bool)
+NO_N = np.zeros(NUM_N, dtype=bool)
+FULL_SUSCEPTIBILITY = np.ones([NUM_H, NUM_N], dtype=bool)
+NO_VIRUSES.flags.writeable = False
+NO_H.flags.writeable = False
+NO_N.flags.writeable = False
+FULL_SUSCEPTIBILITY.flags.writeable = False
+
+SPECIES = ["Human", "Pig", "Bird", "Poultry"]
+
+# Ways VirusModel can advance the hosts each step.
+# "agent" steps every Host object through the mesa schedule.
+# "vectorized" keeps every host in one Population and runs each stage over all of them at once.
+# "packed" steps PackedHost agents, which hold their viruses and immunity as bit masks.
+# "gillespie" keeps every host in an EventPopulation, which draws events from their rates instead of stepping every host.
+# "compartments" lumps hosts in the same state together and only keeps the number of hosts in each state.
+ENGINES = ["agent", "packed", "vectorized", "gillespie", "compartments"]
+
+# Engines that hold every host in one Population instead of Host agents
+POPULATION_ENGINES = ["vectorized", "gillespie", "compartments"]
+
+# Engines that draw contacts as events, so they have no meanfield transmission
+EVENT_ENGINES = ["gillespie", "compartments"]
+
+# Ways a host decides which viruses its contacts transmit.
+# "contact" draws once for every virus of every contact.
+# "binomial" counts the contacts carrying each virus and draws once per virus,
+# with probability 1 - (1 - transmission_prob * susceptibility) ** count, or a product over contacts of different species.
+# "meanfield" draws no contacts. Hosts catch each virus with a probability looked up in a species x virus
+# table made once per step from contact_rates and the prevalence of each virus, see infection_probabilities.
+TRANSMISSIONS = ["contact", "binomial", "meanfield"]
+
+# What immigrants do. Each step every host is matched by an immigrant with probability immigration_rate.
+# "replace" has the immigrant take the host's place, so the population keeps its size.
+# "append" adds the immigrant to the population as well.
+IMMIGRATIONS = ["replace", "append"]
+
+# Who decides which hosts mutate, recover and die each step.
+# "host" has every host roll for each of them.
+# "model" draws the binomial number of hosts of each species it happens to, then picks exactly those hosts.
+EVENT_DRAWS = ["host", "model"]
+
+# Probabilities of the per host events. Each Host has its own, a population one for all its hosts
+# along with death_rate_factors. Checkpoints save them, as they can be changed after the model is made.
+HOST_RATES = ["mutation_prob", "recovery_prob", "death_rate"]
+
+# Bit masks used by PackedHost. Virus HiNj is bit i * NUM_N + j of a strain set,
+# so each row of the virus matrix is a NUM_N bit slice of it.
+ALL_H = (1 << NUM_H) - 1
+ALL_N = (1 << NUM_N) - 1
+ALL_STRAINS = (1 << NUM_H * NUM_N) - 1
+
+# Seed models use when none is given
+DEFAULT_SEED = 2021
+
+# Adjacency matrix of gaussian contact rate distributions where entry ij is
+# the contact rate species j to species i.
+# 1 -> humans
+# 2 -> pigs
+# 3 -> birds
+# 4 -> poultry
+# todo: put more reasonable values
+CONTACT_RATES = np.array([[0.01, 0.0045, 0.002, 0.001],
+                          [0.0045, 0.0095, 0.003, 0.0045],
+                          [0.002, 0.003, 0.09, 0.003],
+                          [0.001, 0.0045, 0.003, 0.01]])
 
 
 #species_infected = np.sum(infection_table, axis=0)
 #fitness = (np.ones((17, 10)) / species_infected) * rng.normal(1, 0.2, (17, 10))
 
+class HostBuffers:
+
+    def __init__(self):
+        """
+        Scratch arrays that Host stages compute into. One set is shared by every host of a model,
+        since hosts are stepped one at a time, so recombining and recovering allocate no temporary arrays.
+        """
+
+        self.viruses = np.zeros([NUM_H, NUM_N], dtype=bool)
+        self.H = np.zeros(NUM_H, dtype=bool)
+        self.N = np.zeros(NUM_N, dtype=bool)
+
+
+def writable(current, buffer):
+    """
+    Returns the array a host stage should write its new values into. That is the host's current array when
+    the host owns it, so a host that stays infected keeps writing over the same matrix, or else the scratch buffer.
+    The shared read only arrays and arrays of another type that were handed to the host are never written to.
+
+    Args:
+        current: The array the host holds now.
+        buffer: The matching HostBuffers array.
+    """
+
+    if current.flags.writeable and current.dtype == bool:
+        return current
+    return buffer
+
+
+def kept(values, buffer, empty):
+    """Returns what a host should hold: values, a copy of them if they are in the scratch buffer, or empty when none are set."""
+
+    if not np.count_nonzero(values):  # Cheaper than any() on arrays this small
+        return empty
+    return values.copy() if values is buffer else values
+
+
 class Host(Agent):
 
+    # Hosts only hold these attributes, so there is no per host __dict__ to grow.
+    # mesa's Agent has no __slots__, so a host still has a __dict__, but it stays empty.
+    __slots__ = ("unique_id", "model", "pos", "id", "it", "mutation_prob", "recovery_prob", "death_rate", "mutating",
+                 "viruses", "H", "N", "susceptibility", "species", "species_id", "temp_viruses", "contact_index")
+
     def __init__(self, model, species, viruses=ZEROS):
         """
         Creates a new host organism
@@ -50,22 +160,20 @@ class Host(Agent):
         self.mutation_prob = 0.0001  # Probability that one virus mutates
         self.recovery_prob = 0.1  # Probability that host recovers from ALL viruses
         self.death_rate = 0.005  # Probability that host dies
+        self.mutating = False  # Set by the model when it decided the host mutates this step
 
 
-        # Viruses will be held in a matrix of size num_H x num_N.
-        # The entry i,j represents the probability of having virus HiNj.
-        self.viruses = ZEROS + viruses
-        self.H = np.sum(self.viruses,
-                        axis=1)  # Sum up rows to get an array that has a positive number in entry i when Hi is present.
-        self.N = np.sum(self.viruses,
-                        axis=0)  # Sum up each column to get an array with a positive number in entry i when Ni is present.
+        # Viruses will be held in a boolean matrix of size num_H x num_N.
+        # The entry i,j is True when the host has virus HiNj.
+        # Uninfected hosts all share the read only NO_VIRUSES, NO_H and NO_N until they catch something.
+        self.set_viruses(np.asarray(viruses) > 0)
 
         # Susceptiblity matrix. Entry i,j is 1 if susceptible to HiNj,
         # 0 if immune. A value in between represents partial susceptibility.
-        self.susceptibility = ONES
+        self.susceptibility = FULL_SUSCEPTIBILITY
 
         self.species = species  # Species of the host organism
-        self.species_id = ["Human", "Pig", "Bird", "Poultry"].index(self.species)  # Species id number for looking up in infection table with
+        self.species_id = SPECIES.index(self.species)  # Species id number for looking up in infection table with
 
         # Sets species specific mortality rates, relative to base rate.
         if self.species == "Human":
@@ -78,13 +186,7 @@ class Host(Agent):
             self.death_rate = self.death_rate * 1.5
 
         # Holder for viruses after contact before all individuals have contacted each other
-        self.temp_viruses = ZEROS
-
-
-        # sets variables for agent reporters to measure each virus
-        self.virus_list = [tuple(x) for x in np.asarray(np.where(self.viruses == 1)).T]
-        for i in all_viruses:
-            setattr(self, f"H{i[0] + 1}N{i[1] + 1}", int(tuple(i) in self.virus_list))
+        self.temp_viruses = NO_VIRUSES
 
     def __eq__(self, other):
         """Says two agents are equal if they share the same unique id"""
@@ -99,37 +201,41 @@ class Host(Agent):
         """
 
 
-        if rng.random() < .01:
+        if self.model.rng.random() < .01:
             print(self.species, self.viruses)
 
 
-        contacts = self.contacts()  # Get list of contacts
-        exposures = [contact.viruses for contact in contacts]  # Get virus matrices of those agen was exposed to
-
-        # Find the transmission probability of each virus, taking into account susceptibility
-        transmission_probabilities = [exposure *
-                                      self.model.transmission_prob *
-                                      self.susceptibility
-                                      for exposure in
-                                      exposures]
-
-        # Decide which viruses successfully infected the agent
-        transmitted_viruses = [self.collapse_probabilities(p) for p in
-                               transmission_probabilities]
+        if self.model.transmission == "meanfield":
+            # No contacts, the chance of catching each virus is looked up in the model's table.
+            transmission_probabilities = self.model.infection_probabilities[self.species_id] * self.susceptibility
+            transmitted_viruses = self.collapse_probabilities(transmission_probabilities)
 
-        # Sum up all the infections from each contact
-        transmitted_viruses = np.sum(transmitted_viruses, axis=0)
+        else:
+            contacts = self.contacts()  # Get indices of contacts
+            contacts = contacts[self.model.contact_infected[contacts]]  # Only infected contacts can pass a virus on
+            exposures = self.model.contact_states[contacts]  # Get virus matrices of those agen was exposed to
 
-        # Filter out the ones species is resistant to.
-        transmitted_viruses = infection_table[
-                                  self.species_id] * transmitted_viruses
+            # Chance that each contact passes each virus to this host. Zero for viruses the species is resistant to.
+            table = self.model.transmission_table[self.species_id][self.model.contact_species[contacts]]
 
-        # Store these viruses in the temp viruses variable until after all contacts are finished.
-        self.temp_viruses = transmitted_viruses
+            if self.model.transmission == "binomial":
+                # Chance that at least one of the contacts carrying each virus transmits it
+                transmission_probabilities = 1 - np.prod(1 - exposures * table * self.susceptibility, axis=0)
+                transmitted_viruses = self.collapse_probabilities(transmission_probabilities)
 
+            else:
+                # Find the transmission probability of each virus, taking into account susceptibility
+                transmission_probabilities = exposures * table * self.susceptibility
 
+                # Decide which viruses successfully infected the agent
+                transmitted_viruses = self.collapse_probabilities(transmission_probabilities)
 
+                # Combine the infections from each contact
+                transmitted_viruses = np.any(transmitted_viruses, axis=0)
 
+        # Store these viruses in the temp viruses variable until after all contacts are finished.
+        # Hosts that caught nothing share NO_VIRUSES instead of holding a matrix of zeros.
+        self.temp_viruses = transmitted_viruses if np.count_nonzero(transmitted_viruses) else NO_VIRUSES
 
     def recombine(self):
         """
@@ -139,19 +245,31 @@ class Host(Agent):
         Finally all viruses within the host recombine.
         """
 
-        self.viruses += self.temp_viruses  # Add transmitted viruses to matrix of viruses host has AFTER all hosts went though the transmission step
-        self.viruses = self.viruses.astype(float)  # Convert from bool to floats
-
-
-
-        self.H = np.sum(self.viruses, axis=1)  # Sum up rows to get an array that has a positive number in entry i when Hi is present.
-        self.N = np.sum(self.viruses, axis=0)  # Sum up each column to get an array with a positive number in entry i when Ni is present.
-        self.H, self.N = self.mutate(self.H, self.N)
-        combos = np.outer(self.H, self.N)  # Outer product to get every possible combination.
-
-        combos = combos >= ONES  # Ensure any number above 1 becomes 1. All others become zero.
-        self.viruses = combos.astype(float)  # Convert from bool to floats
-
+        if self.viruses is NO_VIRUSES and self.temp_viruses is NO_VIRUSES:
+            # Nothing to recombine. The host still rolls for a mutation, which it throws away having no viruses.
+            self.H, self.N = self.mutate(NO_H, NO_N)
+            return
+
+        # Written over the host's own arrays, or the model's scratch arrays when the host has none yet.
+        buffers = self.model.buffers
+        viruses = np.logical_or(self.viruses, self.temp_viruses, out=buffers.viruses)  # Add transmitted viruses to the ones the host has
+        H = np.logical_or.reduce(viruses, axis=1, out=writable(self.H, buffers.H))  # True in entry i when Hi is present.
+        N = np.logical_or.reduce(viruses, axis=0, out=writable(self.N, buffers.N))  # True in entry j when Nj is present.
+        H, N = self.mutate(H, N)
+        combos = np.logical_and.outer(H, N, out=writable(self.viruses, viruses))  # Outer product to get every possible combination.
+
+        self.viruses = kept(combos, buffers.viruses, NO_VIRUSES)
+        self.H = kept(H, buffers.H, NO_H)
+        self.N = kept(N, buffers.N, NO_N)
+
+    def set_viruses(self, viruses):
+        """Stores a boolean virus matrix and the proteins in it, or the shared empty ones when it has no viruses."""
+
+        H = viruses.any(axis=1)
+        if H.any():
+            self.viruses, self.H, self.N = viruses, H, viruses.any(axis=0)
+        else:
+            self.viruses, self.H, self.N = NO_VIRUSES, NO_H, NO_N
 
     def mutate(self, H, N):
         """
@@ -168,18 +286,34 @@ class Host(Agent):
 
         """
 
-        if rng.random(1) < self.mutation_prob:
-            if rng.random(1) < .5:  # Equal chance to mutate into H or N
+        if self.mutates():
+            if self.model.rng.random() < .5:  # Equal chance to mutate into H or N
                 # Pick a random index and add to the H list
-                new_H_index = rng.integers(NUM_H)
-                H[new_H_index] += 1
+                new_H_index = self.model.rng.integers(NUM_H)
+                if not H.flags.writeable:
+                    H = H.copy()  # H is the shared NO_H
+                H[new_H_index] = True
             else:
                 # Pick a random N and add to N list.
-                new_N_index = rng.integers(NUM_N)
-                N[new_N_index] += 1
+                new_N_index = self.model.rng.integers(NUM_N)
+                if not N.flags.writeable:
+                    N = N.copy()
+                N[new_N_index] = True
 
         return H, N
 
+    def mutates(self):
+        """
+        Decides if a mutation happens in the host this step.
+        When the model draws events for all hosts at once it already decided this and set self.mutating.
+        """
+
+        if self.model.event_draws == "model":
+            mutates, self.mutating = self.mutating, False
+            return mutates
+
+        return self.model.rng.random() < self.mutation_prob
+
     def recover(self):
         """
         STAGE 3
@@ -188,27 +322,31 @@ class Host(Agent):
         (This might be a hugely unrealistic approximation with the host recovering from everything at once.)
         """
 
-        if rng.random(1) < self.recovery_prob:
+        if self.model.rng.random() < self.recovery_prob:
+            self.clear_infection()
 
-            # ADD IMMUNITY
-            # TODO: Outer products may be in wrong order. Need to run tests.
+    def clear_infection(self):
+        """Host recovers from all current viruses and becomes immune to those of that type."""
 
-            # Make a matrix where every H row is filled with a positive number if and only if the host has at
-            # least one virus with that H protein.
-            immune_H = np.outer(self.H, np.ones(NUM_N))
+        # ADD IMMUNITY
+        if not (np.count_nonzero(self.H) or np.count_nonzero(self.N)):
+            self.susceptibility = FULL_SUSCEPTIBILITY  # No proteins to become immune to
 
-            # Same thing but fill each N column with positive numbers if the host has a virus with that N protein
-            immune_N = np.outer(np.ones(NUM_H), self.N)
+        else:
+            # Written over the host's own susceptibility matrix when it has one.
+            susceptibility = self.susceptibility
+            if not (susceptibility.dtype == bool and susceptibility.flags.writeable):
+                susceptibility = np.empty([NUM_H, NUM_N], dtype=bool)
 
-            # Add these together. All positive entries are the virus the host is immune to.
-            immune = immune_N + immune_H
-            immune = immune > 0  # Change to boolean matrix with True in entry i,j if the host is immune to HiNj
+            # Make a matrix with True in entry i,j if and only if the host has at least one virus with
+            # the Hi protein or one with the Nj protein. Those are the viruses the host is immune to.
+            np.logical_or.outer(self.H, self.N, out=susceptibility)
 
             # Invert this boolean matrix to figure out what viruses the host is susceptible to.
-            self.susceptibility = np.invert(immune).astype(float)  # invert so that is a susceptibility matrix instead of an immunity one.
+            self.susceptibility = np.logical_not(susceptibility, out=susceptibility)
 
-            # Host recovers from all viruses
-            self.viruses = ZEROS
+        # Host recovers from all viruses
+        self.viruses = NO_VIRUSES
 
 
     def birth_death(self):
@@ -221,34 +359,30 @@ class Host(Agent):
         (We can calculate the number of viruses via np.sum(self.viruses))
         """
 
-        # If die just replace host with an empty one. Ie a new organism took the old one's place.
-        if rng.random(1) < self.death_rate:
-            self.viruses = ZEROS
-            self.susceptibility = ONES
-
+        if self.model.rng.random() < self.death_rate:
+            self.die()
 
-    def contacts(self):
-        """Returns a list of other organism the host has contacted and got viruses from."""
+    def die(self):
+        """Host dies and a newborn of the same species takes its place."""
 
-        contacts = []
+        # If die just replace host with an empty one. Ie a new organism took the old one's place.
+        self.viruses = NO_VIRUSES
+        self.susceptibility = FULL_SUSCEPTIBILITY
 
-        num_contacts = int(self.model.len_hosts_0 * self.model.contact_rates[self.species_id][0])
-        samp = list(rng.choice(self.model.hosts_0, num_contacts))
-        contacts = contacts + samp
 
-        num_contacts = int(self.model.len_hosts_1 * self.model.contact_rates[self.species_id][1])
-        samp = list(rng.choice(self.model.hosts_1, num_contacts))
-        contacts = contacts + samp
+    def contacts(self):
+        """
+        Returns the indices into model.contact_states of the organisms the host has contacted and got viruses from.
+        They are drawn for every host at once by VirusModel.sample_contacts.
+        """
 
-        num_contacts = int(self.model.len_hosts_2 * self.model.contact_rates[self.species_id][2])
-        samp = list(rng.choice(self.model.hosts_2, num_contacts))
-        contacts = contacts + samp
+        return self.model.contact_indices[self.species_id][self.contact_index]
 
-        num_contacts = int(self.model.len_hosts_3 * self.model.contact_rates[self.species_id][3])
-        samp = list(rng.choice(self.model.hosts_3, num_contacts))
-        contacts = contacts + samp
+    @staticmethod
+    def stack_states(hosts):
+        """Stacks the virus matrices of hosts into one array that contacts can be gathered from."""
 
-        return contacts
+        return np.asarray([host.viruses for host in hosts]).reshape(-1, NUM_H, NUM_N)
 
     def collapse_probabilities(self, p):
         """
@@ -260,32 +394,1048 @@ class Host(Agent):
             p: Numpy probability array
 
         Returns:
-            A probability matrix of Trues and Falses (ie zeros and ones.)
+            A boolean matrix of Trues and Falses (ie zeros and ones.)
+        """
+
+        r = self.model.rng.random(np.shape(p))  # Random matrix with uniform probability between zero and one
+        return r < p
+
+
+def virus_reporter(i, j):
+    """Returns a property that is 1 when a host has HiNj and 0 otherwise, computed from its virus matrix."""
+
+    return property(lambda host: int(host.viruses[i, j] > 0), doc=f"1 if the host has H{i + 1}N{j + 1}, else 0.")
+
+
+def add_virus_reporters(cls):
+    """
+    Gives a host class the H1N1, H1N2, ... attributes that mesa's DataCollector uses as agent reporters.
+    They are read off the virus matrix when asked for instead of being stored on every host.
+    """
+
+    for i in range(NUM_H):
+        for j in range(NUM_N):
+            setattr(cls, f"H{i + 1}N{j + 1}", virus_reporter(i, j))
+
+
+add_virus_reporters(Host)
+
+def draw_contacts(pools, contact_rates, rng):
+    """
+    Draws the contacts of every host for one step.
+
+    Every host of species i contacts int(len(pools[j]) * contact_rates[i][j]) random hosts of species j,
+    so the contacts for a species pair are drawn in one call as a matrix of indices.
+
+    Args:
+        pools: Array of host indices for each species.
+        contact_rates: Species x species matrix of contact rates.
+        rng: The numpy Generator to draw with.
+
+    Returns:
+        A list with a num_hosts x num_contacts matrix of contact indices for each species, where row k
+        holds the contacts of host pools[i][k].
+    """
+
+    num_species = len(pools)
+    contact_rates = np.reshape(contact_rates, (num_species, num_species))
+
+    contacts = []
+    for i, hosts in enumerate(pools):
+        drawn = [np.empty((len(hosts), 0), dtype=np.int64)]
+        for j, pool in enumerate(pools):
+            num_contacts = int(len(pool) * contact_rates[i][j])
+            if len(hosts) and num_contacts:
+                drawn.append(pool[rng.integers(len(pool), size=(len(hosts), num_contacts))])
+        contacts.append(np.concatenate(drawn, axis=1))
+
+    return contacts
+
+
+def infection_probabilities(strain_counts, sizes, contact_rates, transmission_prob):
+    """
+    Returns the probability that a host of each species catches each virus this step when every
+    species mixes homogeneously, as a species x NUM_H x NUM_N table.
+
+    A host of species i makes int(sizes[j] * contact_rates[i][j]) contacts with species j, as in
+    draw_contacts. Each of them carries virus HxNy with its prevalence in species j and passes it on
+    with transmission_prob, so the chance of not catching it is a product over species. In logs that
+    is a sum over species of the contact counts times the log chance of a contact not passing each virus on.
+
+    Args:
+        strain_counts: Species x NUM_H x NUM_N array with the number of hosts infected by each virus.
+        sizes: Number of hosts of each species.
+        contact_rates: Species x species matrix of contact rates.
+        transmission_prob: Probability that a contact passes on each virus it carries, or a transmission table
+            with one per pair of species, see compile_transmission_table.
+    """
+
+    sizes = np.asarray(sizes, dtype=float)
+    num_species = len(sizes)
+    contacts = np.floor(sizes[np.newaxis, :] * np.reshape(contact_rates, (num_species, num_species)))
+    prevalence = np.asarray(strain_counts).reshape(num_species, -1) / np.maximum(sizes, 1)[:, np.newaxis]
+    passed = np.broadcast_to(np.multiply(np.reshape(transmission_prob, np.shape(transmission_prob)[:2] + (-1,)),
+                                         prevalence), (num_species, num_species, prevalence.shape[1]))
+
+    # Log chance that one contact does not pass the virus on. Kept finite so no contacts means no chance.
+    escape = np.log(np.maximum(1 - passed, np.finfo(float).tiny))
+    return (1 - np.exp(np.einsum("ij,ijv->iv", contacts, escape))).reshape(np.shape(strain_counts))
+
+
+@functools.lru_cache(maxsize=None)
+def compile_transmission_table(transmission_prob, fitness_on=True):
+    """
+    Returns the probability that a contact of species j passes each virus it carries on to a host of species i,
+    as a species x species x NUM_H x NUM_N array indexed [i, j].
+
+    Folds transmission_prob, the transmission_fitness of the source species to the target species and the
+    infection_table of the target species together, so transmission is one lookup per exposure.
+    It is the one place that decides which viruses a species can catch. Every engine, including meanfield
+    transmission through infection_probabilities, draws from it, so none of them mask infection_table again.
+    The table is made once per set of arguments and shared read only.
+
+    Args:
+        transmission_prob: Probability that a contact passes on each virus it carries.
+        fitness_on: If False, transmission_fitness is left out.
+    """
+
+    fitness = np.swapaxes(np.asarray(transmission_fitness, dtype=float), 0, 1)  # Indexed [target, source]
+    if not fitness_on:
+        fitness = np.ones_like(fitness)
+    infectable = np.asarray(infection_table) > 0
+    table = np.clip(transmission_prob * fitness * infectable[:, np.newaxis], 0, 1)
+    table.setflags(write=False)
+    return table
+
+
+def draw_events(num_hosts, p, rng):
+    """
+    Returns the indices of the hosts an event with probability p happens to.
+    Same as rolling once per host, but only takes O(number of events) random draws.
+    """
+
+    return rng.choice(num_hosts, rng.binomial(num_hosts, p), replace=False)
+
+
+def pack_viruses(viruses):
+    """Turns a NUM_H x NUM_N virus matrix into a strain set bit mask. Any positive entry counts as present."""
+
+    bits = np.packbits(np.asarray(viruses).reshape(-1) > 0, bitorder="little")
+    return int.from_bytes(bits.tobytes(), "little")
+
+
+def unpack_viruses(strains):
+    """Turns a strain set bit mask back into a NUM_H x NUM_N matrix of floats."""
+
+    size = (NUM_H * NUM_N + 7) // 8
+    bits = np.unpackbits(np.frombuffer(strains.to_bytes(size, "little"), dtype=np.uint8), bitorder="little")
+    return bits[:NUM_H * NUM_N].reshape(NUM_H, NUM_N).astype(float)
+
+
+def spread_rows(H):
+    """Returns the strain set with bit 0 of every row whose H bit is set. Multiplying it by an N mask gives their outer product."""
+
+    rows = 0
+    i = 0
+    while H:
+        if H & 1:
+            rows |= 1 << i * NUM_N
+        H >>= 1
+        i += 1
+    return rows
+
+
+ALL_ROWS = spread_rows(ALL_H)
+
+
+class PackedHost(Host):
+
+    __slots__ = ("strains", "temp_strains", "immune_H", "immune_N")
+
+    def __init__(self, model, species, viruses=ZEROS):
+        """
+        A host that holds its viruses as one NUM_H * NUM_N bit strain set and its immunity as
+        a NUM_H bit H mask plus a NUM_N bit N mask, instead of float matrices.
+
+        The viruses, temp_viruses and susceptibility matrices of Host are still available
+        as properties, so it can be used anywhere a Host is.
+        """
+
+        self.strains = 0  # Bit i * NUM_N + j is set when the host has HiNj
+        self.temp_strains = 0  # Strains transmitted this step
+        self.immune_H = 0  # Bit i is set when the host is immune to Hi
+        self.immune_N = 0  # Bit j is set when the host is immune to Nj
+        super().__init__(model, species, viruses)
+        self.H, self.N = self.masks(self.strains)  # Masks instead of Host's arrays
+
+    @property
+    def viruses(self):
+        return unpack_viruses(self.strains)
+
+    @viruses.setter
+    def viruses(self, viruses):
+        self.strains = pack_viruses(viruses)
+
+    @property
+    def temp_viruses(self):
+        return unpack_viruses(self.temp_strains)
+
+    @temp_viruses.setter
+    def temp_viruses(self, viruses):
+        self.temp_strains = pack_viruses(viruses)
+
+    @property
+    def susceptibility(self):
+        return unpack_viruses(self.susceptible_strains())
+
+    @susceptibility.setter
+    def susceptibility(self, susceptibility):
+        # Rows and columns without a single susceptible entry are the immune H and N.
+        susceptible = np.asarray(susceptibility) > 0
+        self.immune_H = pack_viruses(~susceptible.any(axis=1)) & ALL_H
+        self.immune_N = pack_viruses(~susceptible.any(axis=0)) & ALL_N
+
+    @staticmethod
+    def masks(strains):
+        """Returns the H mask and N mask of the proteins present in a strain set."""
+
+        H = 0
+        N = 0
+        i = 0
+        while strains:
+            row = strains & ALL_N
+            if row:
+                H |= 1 << i
+                N |= row
+            strains >>= NUM_N
+            i += 1
+        return H, N
+
+    @staticmethod
+    def stack_states(hosts):
+        """Stacks the strain sets of hosts into one array of packed bytes that contacts can be gathered from."""
+
+        size = (NUM_H * NUM_N + 7) // 8
+        states = b"".join(host.strains.to_bytes(size, "little") for host in hosts)
+        return np.frombuffer(states, dtype=np.uint8).reshape(-1, size)
+
+    def susceptible_strains(self):
+        """Returns the strain set of viruses the host is not immune to."""
+
+        immune = spread_rows(self.immune_H) * ALL_N | ALL_ROWS * self.immune_N
+        return ALL_STRAINS & ~immune
+
+    def contract_virus(self):
+        """
+        STAGE 1
+        Same as Host.contract_virus. Every transmission succeeds with the same probability,
+        so the viruses passed on by a contact are its strain set ANDed with a random strain set.
         """
 
-        r = np.random.rand(NUM_H, NUM_N)  # Random matrix with uniform probability between zero and one
-        a = r < p
-        return a.astype(float)
+        if self.model.transmission == "meanfield":
+            draws = self.model.rng.random(NUM_H * NUM_N) < self.model.infection_probabilities[self.species_id].reshape(-1)
+            self.temp_strains = pack_viruses(draws) & self.susceptible_strains()
+            return
+
+        contacts = self.contacts()
+        contacts = contacts[self.model.contact_infected[contacts]]  # Only contacts with a virus can pass one on
+        infected = self.model.contact_states[contacts]
+        table = self.model.transmission_table[self.species_id][self.model.contact_species[contacts]]
+        table = table.reshape(len(contacts), NUM_H * NUM_N)
+
+        if self.model.transmission == "binomial":
+            carried = np.unpackbits(infected, axis=1, bitorder="little")[:, :NUM_H * NUM_N]
+            draws = self.model.rng.random(NUM_H * NUM_N) < 1 - np.prod(1 - carried * table, axis=0)
+            transmitted = pack_viruses(draws)
+        else:
+            draws = self.model.rng.random((len(infected), NUM_H * NUM_N)) < table
+            transmitted = np.bitwise_or.reduce(infected & np.packbits(draws, axis=1, bitorder="little"), axis=0)
+            transmitted = int.from_bytes(transmitted.tobytes(), "little") if len(infected) else 0
+
+        # Filter out the ones the host is immune to. The transmission table already leaves out
+        # the ones its species is resistant to.
+        self.temp_strains = transmitted & self.susceptible_strains()
+
+    def recombine(self):
+        """
+        STAGE 2
+        Same as Host.recombine, with the outer product of the H and N masks done as a multiplication.
+        """
+
+        self.strains |= self.temp_strains
+        self.H, self.N = self.mutate(*self.masks(self.strains))
+        self.strains = spread_rows(self.H) * self.N
+
+    def mutate(self, H, N):
+        """Same as Host.mutate but on H and N masks."""
+
+        if self.mutates():
+            if self.model.rng.random() < .5:  # Equal chance to mutate into H or N
+                H |= 1 << int(self.model.rng.integers(NUM_H))
+            else:
+                N |= 1 << int(self.model.rng.integers(NUM_N))
+
+        return H, N
+
+    def recover(self):
+        """
+        STAGE 3
+        Recovering becomes two mask assignments.
+        """
+
+        if self.model.rng.random() < self.recovery_prob:
+            self.clear_infection()
+
+    def clear_infection(self):
+        """Same as Host.clear_infection."""
+
+        self.immune_H = self.H
+        self.immune_N = self.N
+        self.strains = 0
+
+    def birth_death(self):
+        """
+        STAGE 4
+        Same as Host.birth_death.
+        """
+
+        if self.model.rng.random() < self.death_rate:
+            self.die()
+
+    def die(self):
+        """Same as Host.die."""
+
+        self.strains = 0
+        self.immune_H = 0
+        self.immune_N = 0
+
+class IndexSet:
+
+    def __init__(self, capacity):
+        """
+        A set of host indices that can be added to, removed from and sampled in time
+        proportional to the number of hosts changed, not the size of the population.
+
+        Args:
+            capacity: Number of hosts in the population. Hosts are indices below it.
+        """
+
+        self.members = np.empty(capacity, dtype=np.int32)  # The first size entries are the hosts in the set
+        self.position = np.full(capacity, -1, dtype=np.int32)  # Index of each host in members, or -1 if not in the set
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, host):
+        return self.position[host] >= 0
+
+    def add(self, hosts):
+        """Adds hosts to the set."""
+
+        hosts = np.unique(hosts)
+        hosts = hosts[self.position[hosts] < 0]
+        if not len(hosts):
+            return
+        self.members[self.size:self.size + len(hosts)] = hosts
+        self.position[hosts] = np.arange(self.size, self.size + len(hosts))
+        self.size += len(hosts)
+
+    def discard(self, hosts):
+        """Removes hosts from the set. Members from the end of the list are moved into their places."""
+
+        hosts = np.unique(hosts)
+        hosts = hosts[self.position[hosts] >= 0]
+        if not len(hosts):
+            return
+        positions = self.position[hosts]
+        self.position[hosts] = -1
+        size = self.size - len(hosts)
+
+        holes = positions[positions < size]
+        tail = self.members[size:self.size]
+        kept = tail[self.position[tail] >= 0]  # As many as there are holes
+        self.members[holes] = kept
+        self.position[kept] = holes
+        self.size = size
+
+    def update(self, hosts, present):
+        """Adds the hosts where present is True and removes the others. Faster than add and discard for one host."""
+
+        if len(hosts) == 1:
+            host = hosts[0]
+            position = self.position[host]
+            if present[0] and position < 0:
+                self.members[self.size] = host
+                self.position[host] = self.size
+                self.size += 1
+            elif not present[0] and position >= 0:
+                self.size -= 1
+                last = self.members[self.size]
+                self.members[position] = last
+                self.position[last] = position
+                self.position[host] = -1
+            return
+
+        member = self.position[hosts] >= 0
+        self.add(hosts[present & ~member])
+        self.discard(hosts[~present & member])
+
+    def grow(self, capacity):
+        """Allows hosts up to capacity, keeping the members in their order."""
+
+        members = np.empty(capacity, dtype=np.int32)
+        members[:self.size] = self.members[:self.size]
+        position = np.full(capacity, -1, dtype=np.int32)
+        position[:len(self.position)] = self.position
+        self.members, self.position = members, position
+
+    def reset(self, hosts):
+        """Makes the set hold exactly hosts, in that order, so sampling continues as it would have."""
+
+        self.position[:] = -1
+        self.size = len(hosts)
+        self.members[:self.size] = hosts
+        self.position[hosts] = np.arange(self.size)
+
+    def sample(self, n, rng, replace=True):
+        """Returns n random hosts of the set."""
+
+        if replace:
+            return self.members[rng.integers(self.size, size=n)]
+        return self.members[rng.choice(self.size, min(n, self.size), replace=False)]
+
+
+class Population:
+
+    # Same per host rates as Host.
+    mutation_prob = 0.0001  # Probability that one virus mutates
+    recovery_prob = 0.1  # Probability that host recovers from ALL viruses
+    death_rate = 0.005  # Probability that host dies
+    death_rate_factors = np.array([.75, 1.2, 1, 1.5])  # Species specific mortality rates, relative to base rate.
+
+    # Upper bound on the number of contact virus matrices gathered at once in contract_virus.
+    chunk_size = 2 ** 22
+
+    def __init__(self, model, species, viruses=None, capacity=None):
+        """
+        Every host of a model held in arrays so that each stage runs as one batched numpy
+        operation over the whole population instead of once per Host.
+
+        Entry i of each array belongs to host i. viruses[i] and susceptibility[i] are the
+        NUM_H x NUM_N matrices a Host holds, and species[i] is its species id.
+
+        Hosts can be added and removed, see add_hosts and remove_hosts. A host keeps its row until it is removed.
+        The rows of removed hosts are free, with species -1 and no viruses, and are kept on a free list for
+        the next hosts added. The hosts of each species are kept in IndexSets, so both take constant time per host.
+
+        Args:
+            model: The model the population is a part of
+            species: Array with the species id of each host, or -1 for a free row.
+            viruses: num_hosts x NUM_H x NUM_N array of the viruses each host starts with. Defaults to none.
+            capacity: Number of rows to make room for. Rows after the hosts start out free. Defaults to the number of hosts.
+        """
+
+        self.model = model
+        species = np.asarray(species, dtype=np.int8)
+        num_hosts = max(len(species), capacity or 0)
+        self.species = np.full(num_hosts, -1, dtype=np.int8)
+        self.species[:len(species)] = species
+
+        self.viruses = np.zeros((num_hosts, NUM_H, NUM_N), dtype=bool)
+        if viruses is not None:
+            self.viruses[:len(species)] = np.asarray(viruses) > 0
+        self.susceptibility = np.ones((num_hosts, NUM_H, NUM_N), dtype=bool)
+        self.temp_viruses = np.zeros((num_hosts, NUM_H, NUM_N), dtype=bool)
+
+        # Entry i,j is True when host i carries a virus with Hj (or Nj).
+        self.H = self.viruses.any(axis=2)
+        self.N = self.viruses.any(axis=1)
+
+        # Hosts of each species, see pools
+        self.members = [IndexSet(num_hosts) for _ in SPECIES]
+        for i, hosts in enumerate(self.members):
+            hosts.add(np.flatnonzero(self.species == i))
+
+        # Free rows. The first num_free entries are a stack, with the lowest row on top.
+        free = np.flatnonzero(self.species < 0)[::-1]
+        self.free = np.empty(num_hosts, dtype=np.int64)
+        self.free[:len(free)] = free
+        self.num_free = len(free)
+
+        # H and N proteins of the viruses present in the population. Every virus any host carries or
+        # was exposed to lies in the window of rows and columns spanning them, so the stages only work in it.
+        # Only the population engines have a window. Host and PackedHost agents work on their full arrays.
+        self.active_H = np.zeros(NUM_H, dtype=bool)
+        self.active_N = np.zeros(NUM_N, dtype=bool)
+
+        # Infected hosts of each species, updated by the stages that change them
+        self.infected = [IndexSet(num_hosts) for _ in SPECIES]
+        self.refresh(self.hosts())
+        self.receivers = np.zeros(0, dtype=np.int64)  # Hosts that were exposed to a virus in the last contract_virus
+
+    @classmethod
+    def random(cls, model, num_hosts, virus_prob, species=None):
+        """
+        Makes the same random initial population as VirusModel makes out of Host agents, drawn for all hosts at once.
+        Every host is of a random species, unless given an array of species ids, and carries each virus with
+        probability virus_prob.
+        """
+
+        if species is None:
+            species = model.rng.integers(len(SPECIES), size=num_hosts)
+        viruses = model.rng.random((num_hosts, NUM_H, NUM_N)) < virus_prob
+        return cls(model, species, viruses)
+
+    @classmethod
+    def from_state(cls, model, state):
+        """Makes a population with the state returned by get_state."""
+
+        population = cls(model, state["species"], state["viruses"])
+        population.susceptibility[:] = state["susceptibility"]
+        population.H[:] = state["H"]
+        population.N[:] = state["N"]
+        population.active_H[:] = state["active_H"]
+        population.active_N[:] = state["active_N"]
+        for hosts, members in zip(population.infected, np.split(state["infected"], np.cumsum(state["infected_sizes"])[:-1])):
+            hosts.reset(members)
+        if "members" in state:  # Checkpoints from before hosts could be removed have the hosts in order
+            for hosts, members in zip(population.members, np.split(state["members"], np.cumsum(state["member_sizes"])[:-1])):
+                hosts.reset(members)
+            population.free[:len(state["free"])] = state["free"]
+        return population
+
+    def get_state(self):
+        """Returns a dictionary of the arrays that make up the population between steps, for checkpoints."""
+
+        return {
+            "species": self.species,
+            "viruses": self.viruses,
+            "susceptibility": self.susceptibility,
+            "H": self.H,
+            "N": self.N,
+            "active_H": self.active_H,
+            "active_N": self.active_N,
+            # The order of the infected sets decides which hosts get sampled
+            "infected": np.concatenate([hosts.members[:len(hosts)] for hosts in self.infected]),
+            "infected_sizes": np.array([len(hosts) for hosts in self.infected]),
+            "members": np.concatenate(self.pools),
+            "member_sizes": np.array([len(hosts) for hosts in self.members]),
+            "free": self.free[:self.num_free],
+        }
+
+    @classmethod
+    def from_hosts(cls, model, hosts):
+        """Makes a population with the same state as a list of Host agents."""
+
+        population = cls(model, [host.species_id for host in hosts],
+                         [host.viruses for host in hosts])
+        population.susceptibility[:] = np.asarray([host.susceptibility for host in hosts]) > 0
+        population.temp_viruses[:] = np.asarray([host.temp_viruses for host in hosts]) > 0
+        population.H[:] = np.asarray([host.H for host in hosts]) > 0
+        population.N[:] = np.asarray([host.N for host in hosts]) > 0
+        population.receivers = np.flatnonzero(population.temp_viruses.any(axis=(1, 2)))
+        return population
+
+    def __len__(self):
+        return len(self.species) - self.num_free
+
+    @property
+    def capacity(self):
+        """Number of rows, free or not."""
+
+        return len(self.species)
+
+    @property
+    def pools(self):
+        """Indices of the hosts of each species. Used to get contacts."""
+
+        return [hosts.members[:len(hosts)] for hosts in self.members]
+
+    def hosts(self):
+        """Returns the rows that hold a host, in order."""
+
+        if not self.num_free:
+            return np.arange(len(self.species))
+        return np.flatnonzero(self.species >= 0)
+
+    def index_sets(self):
+        """Returns every IndexSet of rows the population keeps, so they can grow and drop removed hosts with it."""
+
+        return self.members + self.infected
+
+    def add_hosts(self, species, viruses=None):
+        """
+        Adds hosts without immunity and returns their rows. Free rows are used first, lowest first.
+        When they run out every array doubles in size, so adding a host takes constant time on average.
+
+        Args:
+            species: Array with the species id of each new host.
+            viruses: num_new_hosts x NUM_H x NUM_N array of the viruses each new host starts with. Defaults to none.
+        """
+
+        if self.model.contact_network is not None:
+            raise ValueError("Hosts cannot be added to a population on a fixed contact network")
+
+        species = np.asarray(species, dtype=np.int8)
+        if len(species) > self.num_free:
+            self.grow(max(2 * self.capacity, len(self) + len(species)))
+
+        rows = self.free[self.num_free - len(species):self.num_free][::-1].copy()
+        self.num_free -= len(species)
+        self.species[rows] = species
+        self.viruses[rows] = False if viruses is None else np.asarray(viruses) > 0
+        self.susceptibility[rows] = True
+        self.temp_viruses[rows] = False
+        self.H[rows] = self.viruses[rows].any(axis=2)
+        self.N[rows] = self.viruses[rows].any(axis=1)
+        for i, hosts in enumerate(self.members):
+            hosts.add(rows[species == i])
+        self.refresh(rows)
+        return rows
+
+    def remove_hosts(self, hosts):
+        """
+        Removes hosts. Their rows become free, and the hosts after them in their species keep their rows.
+
+        Args:
+            hosts: Array of rows of the hosts to remove.
+        """
+
+        if self.model.contact_network is not None:
+            raise ValueError("Hosts cannot be removed from a population on a fixed contact network")
+
+        hosts = np.unique(hosts)
+        hosts = hosts[self.species[hosts] >= 0]
+        for index_set in self.index_sets():
+            index_set.discard(hosts)
+        self.species[hosts] = -1
+        self.viruses[hosts] = False
+        self.susceptibility[hosts] = True
+        self.temp_viruses[hosts] = False
+        self.H[hosts] = False
+        self.N[hosts] = False
+
+        self.free[self.num_free:self.num_free + len(hosts)] = hosts[::-1]
+        self.num_free += len(hosts)
+
+    def grow(self, capacity):
+        """Makes room for capacity rows. Every host keeps its row, and the new rows are free."""
+
+        old = self.capacity
+        for name, fill in [("species", -1), ("viruses", False), ("susceptibility", True), ("temp_viruses", False),
+                           ("H", False), ("N", False)]:
+            array = getattr(self, name)
+            grown = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+            grown[:old] = array
+            setattr(self, name, grown)
+        for index_set in self.index_sets():
+            index_set.grow(capacity)
+
+        # The new rows go under the free rows there already are, which have lower numbers.
+        free = np.empty(capacity, dtype=np.int64)
+        free[:capacity - old] = np.arange(capacity - 1, old - 1, -1)
+        free[capacity - old:capacity - old + self.num_free] = self.free[:self.num_free]
+        self.free = free
+        self.num_free += capacity - old
+
+    def refresh(self, hosts):
+        """Updates the infected sets and active proteins for hosts whose viruses changed."""
+
+        hosts = np.unique(hosts) if len(hosts) > 1 else np.asarray(hosts)
+        viruses = self.viruses[hosts]
+        infected = viruses.any(axis=(1, 2))
+        if infected.any():
+            self.active_H |= viruses[infected].any(axis=(0, 2))
+            self.active_N |= viruses[infected].any(axis=(0, 1))
+        if len(hosts) == 1:  # Most events of the gillespie engine change one host
+            self.infected[self.species[hosts[0]]].update(hosts, infected)
+            return
+
+        for i in range(len(SPECIES)):
+            of_species = self.species[hosts] == i
+            self.infected[i].update(hosts[of_species], infected[of_species])
+
+    @property
+    def window(self):
+        """
+        Returns the slices of the H rows and N columns that span the active proteins.
+        Used by the stages of Population and the engines built on it. The agent engines keep no window,
+        as each Host works on its own NUM_H x NUM_N arrays.
+        """
+
+        rows, columns = np.flatnonzero(self.active_H), np.flatnonzero(self.active_N)
+        if not len(rows) or not len(columns):
+            return slice(0, 0), slice(0, 0)
+        return slice(rows[0], rows[-1] + 1), slice(columns[0], columns[-1] + 1)
+
+    def step(self):
+        """Runs every stage once over the whole population, in the same order as the agent schedule."""
+
+        with self.model.stage("contract_virus", len(self)):
+            self.contract_virus()
+        with self.model.stage("recombine", len(self)):
+            self.recombine()
+        with self.model.stage("recover", len(self)):
+            self.recover()
+        with self.model.stage("birth_death", len(self)):
+            self.birth_death()
+
+    def contract_virus(self):
+        """
+        STAGE 1
+        Every host contacts other hosts and gets exposed to the viruses they have,
+        then it is decided which of those viruses cause infection.
+
+        Only contacts with an infected host can pass anything on, so only those are drawn, see catch_from_contacts.
+        The hosts that were exposed to anything are kept in self.receivers for recombine.
+        """
+
+        H, N = self.window
+        self.temp_viruses[:, H, N] = False
+
+        if self.model.contact_network is not None:
+            self.receivers = self.catch_from_neighbors()
+        elif self.model.transmission == "meanfield":
+            self.receivers = self.catch_viruses()
+        else:
+            self.receivers = self.catch_from_contacts()
+
+    def catch_from_contacts(self):
+        """
+        Draws the contacts of this step from the infected hosts' side. As in draw_contacts, every host of species i
+        makes int(len(pools[j]) * contact_rates[i][j]) contacts with random hosts of species j. Each contact
+        lands on an infected host with the infected fraction of species j, so the contacts that do are drawn with
+        draw_events over all of them, and each picks its source from the species' infected hosts.
+        The work done scales with the number of infectious contacts instead of the number of hosts.
+
+        Returns:
+            The hosts that were exposed to a virus.
+        """
+
+        rng = self.model.rng
+        contact_rates = np.reshape(self.model.contact_rates, (len(SPECIES), len(SPECIES)))
+        H, N = self.window
+        step = max(1, self.chunk_size // max(1, (H.stop - H.start) * (N.stop - N.start)))
+
+        receivers = [np.zeros(0, dtype=np.int64)]
+        for i, hosts in enumerate(self.pools):
+            for j, pool in enumerate(self.pools):
+                num_contacts = int(len(pool) * contact_rates[i][j])
+                infected = self.infected[j]
+                if not (len(hosts) and num_contacts and len(infected)):
+                    continue
+
+                # Contact k of host hosts[m] is slot m * num_contacts + k.
+                slots = draw_events(len(hosts) * num_contacts, len(infected) / len(pool), rng)
+
+                # Gather the contacts' viruses a few at a time to keep memory bounded.
+                for start in range(0, len(slots), step):
+                    contacted = hosts[slots[start:start + step] // num_contacts]
+                    sources = infected.sample(len(contacted), rng)
+                    receivers.append(self.expose(contacted, self.viruses[sources, H, N],
+                                                 self.model.transmission_table[i, j, H, N]))
+
+        return np.concatenate(receivers)
+
+    def expose(self, hosts, exposures, probabilities):
+        """
+        Decides which viruses infect hosts exposed to them, one exposure per contact.
+
+        Args:
+            hosts: Array with the host of every contact. Hosts may repeat.
+            exposures: Array of the viruses each contact carries, within the window of active proteins.
+            probabilities: Chance that a contact passes on each of those viruses, from the model's transmission_table.
+
+        Returns:
+            The distinct hosts.
+        """
+
+        order = np.argsort(hosts, kind="stable")
+        hosts, starts = np.unique(hosts[order], return_index=True)
+        exposures = exposures[order]
+
+        if self.model.transmission == "binomial":
+            # One draw per virus a host was exposed to, however many contacts carried it.
+            counts = np.add.reduceat(exposures, starts, axis=0, dtype=np.int32)
+            exposed = counts > 0
+            with np.errstate(divide="ignore"):  # Certain transmission escapes with log chance -inf
+                escape = np.broadcast_to(np.log1p(-probabilities), exposed.shape)  # Log chance one contact does not pass it on
+            exposed[exposed] = self.model.rng.random(np.count_nonzero(exposed)) < -np.expm1(counts[exposed] * escape[exposed])
+        else:
+            # Only viruses a contact carries need a random draw.
+            exposures[exposures] = (self.model.rng.random(np.count_nonzero(exposures)) <
+                                    np.broadcast_to(probabilities, exposures.shape)[exposures])
+            exposed = np.logical_or.reduceat(exposures, starts, axis=0)
+
+        # Keep the viruses the host is susceptible to.
+        H, N = self.window
+        self.temp_viruses[hosts, H, N] |= exposed & self.susceptibility[hosts, H, N]
+        return hosts
+
+    def catch_from_neighbors(self):
+        """
+        Network version of contract_virus. Every host contacts all of its neighbors in the model's
+        contact_network each step. A host exposed to a virus by k neighbors of one species catches it with
+        probability 1 - (1 - p) ** k, where p is their entry in the transmission_table. That is the same as
+        one draw per neighbor, so the contact and binomial transmission modes are the same here.
+
+        Returns:
+            The hosts that were exposed to a virus.
+        """
+
+        H, N = self.window
+        viruses = self.viruses[:, H, N]
+        receivers = [np.zeros(0, dtype=np.int64)]
+        for j in range(len(SPECIES)):
+            for hosts, counts in self.model.contact_network.exposures(viruses, self.chunk_size, self.species == j):
+                probabilities = self.model.transmission_table[self.species[hosts], j, H, N]
+                exposed = counts > 0
+                exposed[exposed] = (self.model.rng.random(np.count_nonzero(exposed)) <
+                                    1 - (1 - probabilities[exposed]) ** counts[exposed])
+
+                # Keep the viruses the host is susceptible to.
+                self.temp_viruses[hosts, H, N] |= exposed & self.susceptibility[hosts, H, N]
+                receivers.append(hosts)
+
+        return np.concatenate(receivers)
+
+    def catch_viruses(self):
+        """
+        Mean field version of contract_virus. Hosts of species i catch each virus with the probability in
+        row i of infection_probabilities, so the hosts that catch it are drawn with draw_events,
+        once per species and virus, instead of once per host, contact and virus.
+
+        Returns:
+            The hosts that caught a virus.
+        """
+
+        probabilities = infection_probabilities(self.strain_counts(), [len(hosts) for hosts in self.pools],
+                                                self.model.contact_rates, self.model.transmission_table)
+
+        receivers = [np.zeros(0, dtype=np.int64)]
+        for i, hosts in enumerate(self.pools):
+            for H, N in zip(*np.nonzero(probabilities[i])):  # Zero for viruses species i is resistant to
+                caught = hosts[draw_events(len(hosts), probabilities[i, H, N], self.model.rng)]
+                self.temp_viruses[caught, H, N] = self.susceptibility[caught, H, N]
+                receivers.append(caught)
+
+        return np.concatenate(receivers)
+
+    def recombine(self):
+        """
+        STAGE 2
+
+        Transmitted viruses are placed inside the hosts. Then mutations might happen.
+        Finally all viruses within each host recombine.
+        """
+
+        H, N = self.window
+        self.viruses[:, H, N] |= self.temp_viruses[:, H, N]
+        self.H[:] = False
+        self.N[:] = False
+        self.H[:, H] = self.viruses[:, H, N].any(axis=2)
+        self.N[:, N] = self.viruses[:, H, N].any(axis=1)
+
+        # Recombining pairs every H an infected host has with every N, so the active proteins are the ones
+        # infected hosts have. This also drops the proteins of viruses every host cleared.
+        self.active_H = self.H.any(axis=0)
+        self.active_N = self.N.any(axis=0)
+        self.mutate()
+        H, N = self.window
+        np.logical_and(self.H[:, H, np.newaxis], self.N[:, np.newaxis, N], out=self.viruses[:, H, N])
+        self.refresh(self.receivers)  # Mutations need a virus to act on, so only receivers can become infected
+
+    def mutate(self):
+        """Each host has a chance of gaining a new H or N protein. See Host.mutate."""
+
+        mutants = self.hosts()[draw_events(len(self), self.mutation_prob, self.model.rng)]
+        on_H = self.model.rng.random(len(mutants)) < .5  # Equal chance to mutate into H or N
+        H_mutants, new_H = mutants[on_H], self.model.rng.integers(NUM_H, size=np.count_nonzero(on_H))
+        N_mutants, new_N = mutants[~on_H], self.model.rng.integers(NUM_N, size=np.count_nonzero(~on_H))
+        self.H[H_mutants, new_H] = True
+        self.N[N_mutants, new_N] = True
+
+        # A new protein in a host without viruses has nothing to pair with, so only infected mutants activate one.
+        self.active_H[new_H[self.N[H_mutants].any(axis=1)]] = True
+        self.active_N[new_N[self.H[N_mutants].any(axis=1)]] = True
+
+    def recover(self):
+        """
+        STAGE 3
+
+        Hosts that recover lose all current viruses and become immune to those of that type.
+        """
+
+        recovered = self.hosts()[draw_events(len(self), self.recovery_prob, self.model.rng)]
+        self.susceptibility[recovered] = ~(self.H[recovered, :, np.newaxis] | self.N[recovered, np.newaxis, :])
+        self.viruses[recovered] = False
+        self.refresh(recovered)
+
+    def birth_death(self):
+        """
+        STAGE 4
+
+        Hosts that die are replaced by a new host of the same species.
+        """
+
+        for i, hosts in enumerate(self.pools):
+            died = hosts[draw_events(len(hosts), self.death_rate * self.death_rate_factors[i], self.model.rng)]
+            self.viruses[died] = False
+            self.susceptibility[died] = True
+            self.infected[i].discard(died)
+
+    def immigrate(self, p):
+        """
+        STAGE 5
+
+        Immigrants arrive, with probability p for each host. See VirusModel.immigrate.
+        Replacing immigrants take over the rows of the hosts they replace, appended ones get free rows.
+        """
+
+        rng = self.model.rng
+        if self.model.immigration == "append":
+            species = np.repeat(np.arange(len(SPECIES)), rng.binomial([len(hosts) for hosts in self.pools], p))
+            self.add_hosts(species, self.model.immigrant_viruses(species))
+            return
+
+        hosts = np.concatenate([hosts[draw_events(len(hosts), p, rng)] for hosts in self.pools])
+        self.viruses[hosts] = self.model.immigrant_viruses(self.species[hosts])
+        self.susceptibility[hosts] = True
+        self.temp_viruses[hosts] = False
+        self.H[hosts] = self.viruses[hosts].any(axis=2)
+        self.N[hosts] = self.viruses[hosts].any(axis=1)
+        self.refresh(hosts)
+
+    def strain_counts(self):
+        """Returns a species x NUM_H x NUM_N array with the number of hosts infected by each virus."""
+
+        counts = np.zeros((len(SPECIES), NUM_H, NUM_N), dtype=np.int64)
+        H, N = self.window
+        for i, hosts in enumerate(self.pools):
+            counts[i, H, N] = np.count_nonzero(self.viruses[hosts, H, N], axis=0)
+        return counts
+
+
+def pack_meta(value, arrays, name):
+    """
+    Returns value in a form json can write, for checkpoints. Arrays, and the arrays of ContactNetworks,
+    are moved into arrays under names starting with name, and left as references to them.
+    """
+
+    from network import ContactNetwork  # network imports this module
+    if isinstance(value, ContactNetwork):
+        return {"__network__": [pack_meta(value.indptr, arrays, f"{name}/indptr"),
+                                pack_meta(value.indices, arrays, f"{name}/indices"),
+                                pack_meta(value.species, arrays, f"{name}/species")]}
+    if isinstance(value, np.ndarray):
+        arrays[name] = value
+        return {"__array__": name}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, tuple):
+        return {"__tuple__": [pack_meta(item, arrays, f"{name}/{i}") for i, item in enumerate(value)]}
+    if isinstance(value, list):
+        return [pack_meta(item, arrays, f"{name}/{i}") for i, item in enumerate(value)]
+    if isinstance(value, dict):
+        return {key: pack_meta(item, arrays, f"{name}/{key}") for key, item in value.items()}
+    return value
+
+
+def unpack_meta(value, arrays):
+    """Returns the value pack_meta was given, with its arrays taken from arrays."""
+
+    if isinstance(value, list):
+        return [unpack_meta(item, arrays) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if "__array__" in value:
+        return arrays[value["__array__"]]
+    if "__tuple__" in value:
+        return tuple(unpack_meta(item, arrays) for item in value["__tuple__"])
+    if "__network__" in value:
+        from network import ContactNetwork  # network imports this module
+        return ContactNetwork(*unpack_meta(value["__network__"], arrays))
+    return {key: unpack_meta(item, arrays) for key, item in value.items()}
 
 
 class VirusModel(Model):
 
     def __init__(self, run="NA", init_pop_size=[900, 650, 1000, 750], it=0, infection_rate=0.25, recovery_rate=0.2,
                  mutation_rate=0.23, birth_rate=0.04, death_rate=0.03, cross_immunity_effect=0.05, init_viruses=None,
-                 immigration_rate=0.02, contact_rates=None, fitness_on=True, init_hosts=True):
+                 immigration_rate=0, contact_rates=None, fitness_on=True, init_hosts=True, engine="agent",
+                 transmission="contact", event_draws="model", agent_snapshot_interval=None, seed=DEFAULT_SEED,
+                 replicate=0, profile=False, init_virus_prob=.001, contact_graph=None, immigration="replace",
+                 immigrant_virus_prob=.2):
         """
         Args:
             init_pop_size: The initial population size of each species [Humans, Pigs, Birds, Poultry]
             x: Batch runner throws an error without a dummy variable to use as a variable parameter, therefore this variable acts as a dummy
             it: Iteration number
+            engine: How hosts are stepped. One of ENGINES.
+            transmission: How transmitted viruses are drawn. One of TRANSMISSIONS.
+            event_draws: Who decides which hosts mutate, recover and die. One of EVENT_DRAWS.
+            agent_snapshot_interval: If set, also collect every host's viruses every this many steps.
+            seed: Base seed of the model's random number generator.
+            replicate: Replicate number. Models with the same seed but different replicates get independent streams.
+            profile: If True, time every stage of every step in self.profiler.
+            init_virus_prob: Probability that an initial host carries each virus.
+            contact_graph: A networkx graph, or a ContactNetwork compiled from one. If given, every node is a host
+                that contacts its neighbors each step, instead of random hosts at contact_rates. init_pop_size
+                is ignored. Hosts take their species from the "species" node attribute, or a random one.
+            immigration_rate: Probability that an immigrant arrives for each host each step.
+            immigration: What immigrants do. One of IMMIGRATIONS.
+            immigrant_virus_prob: Probability that an immigrant carries each virus. Either one probability, a
+                NUM_H x NUM_N array with one for each virus, or a species x NUM_H x NUM_N array with one for each
+                species and virus.
         """
 
+        # The arguments, so a checkpoint can make the same model again
+        self.init_args = {name: value for name, value in locals().items() if name not in ["self", "__class__"]}
+
+        if engine not in ENGINES:
+            raise ValueError(f"engine must be one of {ENGINES}, not {engine!r}")
+        if transmission not in TRANSMISSIONS:
+            raise ValueError(f"transmission must be one of {TRANSMISSIONS}, not {transmission!r}")
+        if event_draws not in EVENT_DRAWS:
+            raise ValueError(f"event_draws must be one of {EVENT_DRAWS}, not {event_draws!r}")
+        if transmission == "meanfield" and engine in EVENT_ENGINES:
+            raise ValueError(f"The {engine} engine draws contacts as events, so it has no meanfield transmission")
+        if contact_graph is not None and engine != "vectorized":
+            raise ValueError("Contact networks are only supported by the vectorized engine")
+        if contact_graph is not None and transmission == "meanfield":
+            raise ValueError("Hosts on a contact network contact their neighbors, so there is no meanfield transmission")
+        if immigration not in IMMIGRATIONS:
+            raise ValueError(f"immigration must be one of {IMMIGRATIONS}, not {immigration!r}")
+        if contact_graph is not None and immigration == "append" and immigration_rate:
+            raise ValueError("Immigrants cannot be added to a fixed contact network, use immigration=\"replace\"")
+        if engine == "compartments" and agent_snapshot_interval:
+            raise ValueError("The compartments engine does not keep individual hosts, so it cannot take agent snapshots")
+
         super().__init__()  # Initialize basic agent code, assign a unique id
+
+        # Random number generator. Every host and stage draws from this one.
+        self.seed = seed
+        self.replicate = replicate
+        self.rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(replicate,)))
+
+        # Times each stage, or None when not profiling so the step loop is untouched.
+        self.profiler = StageProfiler(self) if profile else None
+
+        # Scratch arrays for the Host stages, see HostBuffers
+        self.buffers = HostBuffers()
+        schedule_class = ProfiledStagedActivation if profile else StagedActivation
+
         self.it = it
         self.run = run
         self.running = True  # For batch runs
         self.model_step = 0  # The number of timesteps the simulation has run
-        self.schedule = StagedActivation(self, ["contract_virus", "recombine", "recover", "birth_death"])  # set schedule
+        self.event_draws = event_draws
+        if event_draws == "model":
+            # Recovery and death are applied by the model to the hosts it picked, see step.
+            self.schedule = schedule_class(self, ["contract_virus", "recombine"])
+        else:
+            self.schedule = schedule_class(self, ["contract_virus", "recombine", "recover", "birth_death"])  # set schedule
         self.infection_rate = infection_rate
         self.recovery_rate = recovery_rate
         self.mutation_rate = mutation_rate
@@ -294,8 +1444,27 @@ class VirusModel(Model):
         self.cross_immunity_effect = cross_immunity_effect  # compare polarizing immunity to semi-crossimmunity
         self.init_viruses = init_viruses
         self.immigration_rate = immigration_rate
+        self.immigration = immigration
+        self.immigrant_virus_prob = immigrant_virus_prob
         self.fitness_on = fitness_on
-        self.transmission_prob = .5
+        self.transmission_prob = .5  # Also compiles transmission_table, see the setter
+        self.engine = engine
+        self.transmission = transmission
+        self.host_class = PackedHost if engine == "packed" else Host
+        self.population = None  # Holds every host when using one of the POPULATION_ENGINES
+
+        # Fixed contacts between hosts, or None to draw random contacts each step
+        self.contact_network = None
+        network_species = None
+        if contact_graph is not None:
+            from network import ContactNetwork  # network imports this module
+            if not isinstance(contact_graph, ContactNetwork):
+                contact_graph = ContactNetwork.from_graph(contact_graph)
+            self.contact_network = contact_graph
+            network_species = contact_graph.species
+            if network_species is None:
+                network_species = self.rng.integers(len(SPECIES), size=len(contact_graph))
+            init_pop_size = list(np.bincount(network_species, minlength=len(SPECIES)))
 
         # Population sizes
         self.human_pop_size = init_pop_size[0]
@@ -313,52 +1482,57 @@ class VirusModel(Model):
         self.model_step = 0
 
 
-        # Adjacency matrix of gaussian contact rate distributions where entry ij is 
-        # the contact rate species j to species i.
-        # 1 -> humans
-        # 2 -> pigs
-        # 3 -> birds
-        # 4 -> poultry
-        # todo: put more reasonable values
+        # Contact rates between species, see CONTACT_RATES
         if contact_rates is None:
-            self.contact_rates = np.array([[0.01, 0.0045, 0.002, 0.001],
-                                           [0.0045, 0.0095, 0.003, 0.0045],
-                                           [0.002, 0.003, 0.09, 0.003],
-                                           [0.001, 0.0045, 0.003, 0.01]]) * 1
+            self.contact_rates = CONTACT_RATES
         else:
             self.contact_rates = contact_rates
 
 
-        if init_hosts:
+        # gillespie and compartments import this module, so they are imported here.
+        population_class = Population
+        if self.engine == "gillespie":
+            from gillespie import EventPopulation
+            population_class = EventPopulation
+        elif self.engine == "compartments":
+            from compartments import CompartmentPopulation
+            population_class = CompartmentPopulation
+
+        if self.contact_network is not None:
+            self.population = population_class.random(self, len(self.contact_network), init_virus_prob,
+                                                      network_species)
+
+        elif init_hosts and self.engine in POPULATION_ENGINES:
+            self.population = population_class.random(self, np.sum(init_pop_size), init_virus_prob)
+
+        elif self.engine in POPULATION_ENGINES:
+            self.population = population_class(self, [])
+
+        elif init_hosts:
             # Initialize population
             # Make a bunch of random organisms for now
             for i in range(np.sum(init_pop_size)):
 
-                species = random.choice(["Human", "Pig", "Bird", "Poultry"])  # Decide species with equal probability.
-                init_viruses = np.random.choice([0, 1], size=(NUM_H, NUM_N), p=[.999, .001])  # Randomly decide some viruses it has
-                host = Host(self, species, init_viruses)  # Make the host
-                self.schedule.add(host)  # Add it to the list of hosts that the model simulates
-
-                # Add host to correct species pool.
-                if species == "Human":
-                    self.hosts_0.append(host)
-                if species == "Pig":
-                    self.hosts_1.append(host)
-                if species == "Birds":
-                    self.hosts_2.append(host)
-                if species == "Poultry":
-                    self.hosts_3.append(host)
-
-            # sets reporters for each virus
-        reporters = "{\"Iteration\":\"it\",\"Species\":\"species\","
-        for i in all_viruses:
-            name = f"H{i[0] + 1}N{i[1] + 1}"
-            reporters = reporters + "\"" + name + "\"" + ":" + "\"" + name + "\"" + ","
-        reporters = reporters[:-1] + "}"
-        self.datacollector = DataCollector(
-            # model_reporters={"Strain_data": Count_Strains}
-            agent_reporters=json.loads(reporters)
-        )
+                species = SPECIES[self.rng.integers(len(SPECIES))]  # Decide species with equal probability.
+                init_viruses = self.rng.choice([0, 1], size=(NUM_H, NUM_N), p=[1 - init_virus_prob, init_virus_prob])  # Randomly decide some viruses it has
+                host = self.host_class(self, species, init_viruses)  # Make the host
+                self.add_host(host)  # Add it to the hosts that the model simulates and its species pool
+
+        # Counts the hosts infected by each virus every step
+        self.datacollector = StrainCollector(SPECIES, agent_interval=agent_snapshot_interval)
+        self.datacollector.profiler = self.profiler
+
+    @property
+    def transmission_prob(self):
+        """Probability that a contact passes on each virus it carries."""
+
+        return self._transmission_prob
+
+    @transmission_prob.setter
+    def transmission_prob(self, transmission_prob):
+        # The table the hosts look transmission up in, remade whenever the probability changes.
+        self._transmission_prob = transmission_prob
+        self.transmission_table = compile_transmission_table(transmission_prob, self.fitness_on)
 
     def step(self):
 
@@ -370,67 +1544,288 @@ class VirusModel(Model):
 
         # collects data after 350 steps
         if self.model_step >= 0:
-            self.datacollector.collect(self)
+            with self.stage("collect", self.total_pop_size):
+                self.datacollector.collect(self)
+
+        if self.population is not None:
+            self.population.step()  # step all hosts at once
+            self.schedule.steps += 1  # Keep the schedule's step count, as the data collector and BatchRunner use it
+            self.schedule.time += 1
+        else:
+            self.len_hosts_0 = len(self.hosts_0)
+            self.len_hosts_1 = len(self.hosts_1)
+            self.len_hosts_2 = len(self.hosts_2)
+            self.len_hosts_3 = len(self.hosts_3)
+
+            with self.stage("sample_contacts", self.schedule.get_agent_count()):
+                self.sample_contacts()
+
+            if self.event_draws == "model":
+                with self.stage("mutate", self.schedule.get_agent_count()):
+                    for host in self.draw_hosts("mutation_prob"):
+                        host.mutating = True
+
+            self.schedule.step()  # step all agents
+
+            if self.event_draws == "model":
+                recovered = self.draw_hosts("recovery_prob")
+                with self.stage("recover", len(recovered)):
+                    for host in recovered:
+                        host.clear_infection()
+                died = self.draw_hosts("death_rate")
+                with self.stage("birth_death", len(died)):
+                    for host in died:
+                        host.die()
+
+        with self.stage("immigrate", self.total_pop_size):
+            self.immigrate(self.immigration_rate)
+
+    def save_checkpoint(self, path):
+        """
+        Saves the state of the model between steps to a compressed .npz file, so the run can be picked up again
+        with load_checkpoint. The population or hosts, random number generator, step counts and the data
+        collected so far are saved. Stage timings of a profiled model are not.
+
+        Args:
+            path: File to write. np.savez_compressed adds .npz if it is missing.
+        """
+
+        arguments = dict(self.init_args)
+        if self.contact_network is not None:
+            arguments["contact_graph"] = self.contact_network  # The compiled arrays instead of the graph
+
+        meta = {
+            "arguments": arguments,
+            "rng": self.rng.bit_generator.state,
+            "model_step": self.model_step,
+            "steps": self.schedule.steps,
+            "time": self.schedule.time,
+            "current_id": self.current_id,
+            "transmission_prob": self.transmission_prob,
+            "running": self.running,
+        }
+        arrays = {f"collector/{name}": value for name, value in self.datacollector.get_state().items()}
+
+        if self.population is not None:
+            arrays.update({f"population/{name}": value for name, value in self.population.get_state().items()})
+            meta["population_rates"] = {name: getattr(self.population, name) for name in HOST_RATES + ["death_rate_factors"]}
+        else:
+            hosts = self.schedule.agents
+            arrays.update({
+                "hosts/ids": np.array([host.unique_id for host in hosts], dtype=np.int64),
+                "hosts/species": np.array([host.species_id for host in hosts], dtype=np.int8),
+                "hosts/viruses": np.array([host.viruses for host in hosts], dtype=bool).reshape(-1, NUM_H, NUM_N),
+                "hosts/susceptibility": np.array([host.susceptibility for host in hosts]).reshape(-1, NUM_H, NUM_N),
+                "hosts/H": np.array([host.H for host in hosts]),  # Arrays for Host, bit masks for PackedHost
+                "hosts/N": np.array([host.N for host in hosts]),
+                "hosts/mutating": np.array([host.mutating for host in hosts], dtype=bool),
+                "hosts/pool_index": np.array([host.contact_index for host in hosts], dtype=np.int64),
+            })
+            arrays.update({f"hosts/{name}": np.array([getattr(host, name) for host in hosts], dtype=float)
+                           for name in HOST_RATES})
+
+        # The rest is json, so loading a checkpoint never unpickles anything.
+        meta = json.dumps(pack_meta(meta, arrays, "meta"))
+        np.savez_compressed(path, meta=np.array(meta), **arrays)
+
+    @classmethod
+    def load_checkpoint(cls, path):
+        """Makes the model saved by save_checkpoint, ready to take its next step."""
+
+        with np.load(path) as data:
+            arrays = {name: data[name] for name in data.files if name != "meta"}
+            meta = unpack_meta(json.loads(str(data["meta"])), arrays)
+
+        def section(prefix):
+            return {name[len(prefix):]: value for name, value in arrays.items() if name.startswith(prefix)}
+
+        model = cls(**dict(meta["arguments"], init_hosts=False))
+        model.datacollector.set_state(section("collector/"))
+
+        if model.population is not None:
+            model.population = type(model.population).from_state(model, section("population/"))
+            for name, value in meta.get("population_rates", {}).items():
+                setattr(model.population, name, value)
+        else:
+            hosts = section("hosts/")
+            for i, species_id in enumerate(hosts["species"]):
+                host = model.host_class(model, SPECIES[species_id], hosts["viruses"][i].astype(float))
+                host.id = host.unique_id = int(hosts["ids"][i])
+                host.susceptibility = hosts["susceptibility"][i]
+                if model.host_class is PackedHost:
+                    host.H, host.N = int(hosts["H"][i]), int(hosts["N"][i])
+                else:
+                    host.H, host.N = hosts["H"][i], hosts["N"][i]
+                host.mutating = bool(hosts["mutating"][i])
+                for name in HOST_RATES:
+                    if name in hosts:  # Older checkpoints leave them at their defaults
+                        setattr(host, name, float(hosts[name][i]))
+                model.add_host(host)
+
+            # Removing hosts reorders the pools, and contacts are drawn by place in them.
+            if "pool_index" in hosts:
+                places = dict(zip(hosts["ids"].tolist(), hosts["pool_index"].tolist()))
+                for pool in [model.hosts_0, model.hosts_1, model.hosts_2, model.hosts_3]:
+                    pool.sort(key=lambda host: places[host.unique_id])
+                    for i, host in enumerate(pool):
+                        host.contact_index = i
+
+        model.rng.bit_generator.state = meta["rng"]
+        model.model_step = meta["model_step"]
+        model.schedule.steps = meta["steps"]
+        model.schedule.time = meta["time"]
+        model.current_id = meta["current_id"]
+        model.transmission_prob = meta["transmission_prob"]
+        model.running = meta["running"]
+        return model
+
+    def stage(self, name, hosts):
+        """
+        Returns a context that times the stage run inside it when profiling.
+        When not profiling it returns one that does nothing.
+        """
+
+        if self.profiler is None:
+            return NOT_PROFILED
+        return self.profiler.stage(name, hosts)
+
+    def sample_contacts(self):
+        """
+        Draws the contacts of every Host for this step, or makes the infection_probabilities table
+        with meanfield transmission.
+
+        The species lists are laid out one after another so the hosts of each species have a
+        contiguous range of indices. contact_states holds every host's viruses at those indices,
+        and contact_indices holds each host's contacts, for Host.contacts to look up.
+        contact_infected marks the hosts that carry a virus, and contact_species holds their species ids.
+        """
+
+        pools = [self.hosts_0, self.hosts_1, self.hosts_2, self.hosts_3]
+        if self.transmission == "meanfield":
+            # No contacts are drawn. Hosts look up their chance of catching each virus instead.
+            self.infection_probabilities = infection_probabilities(self.strain_counts(), [len(pool) for pool in pools],
+                                                                   self.contact_rates, self.transmission_table)
+            return
+
+        hosts = [host for pool in pools for host in pool]
+        offsets = np.cumsum([0] + [len(pool) for pool in pools])
+        self.species_indices = [np.arange(offsets[i], offsets[i + 1]) for i in range(len(pools))]
+
+        # Each host's row in contact_indices is its place in its pool, host.contact_index, kept by add_host and remove_host.
+        self.contact_states = self.host_class.stack_states(hosts)
+        self.contact_infected = self.contact_states.any(axis=tuple(range(1, self.contact_states.ndim)))
+        self.contact_species = np.repeat(np.arange(len(pools)), [len(pool) for pool in pools])
+        self.contact_indices = draw_contacts(self.species_indices, self.contact_rates, self.rng)
+
+    def add_host(self, host):
+        """Adds a Host agent to the schedule and the end of its species pool."""
 
-        self.len_hosts_0 = len(self.hosts_0)
-        self.len_hosts_1 = len(self.hosts_1)
-        self.len_hosts_2 = len(self.hosts_2)
-        self.len_hosts_3 = len(self.hosts_3)
+        pool = [self.hosts_0, self.hosts_1, self.hosts_2, self.hosts_3][host.species_id]
+        host.contact_index = len(pool)
+        pool.append(host)
+        self.schedule.add(host)
 
-        self.schedule.step()  # step all agents
-        self.immigrate(self.immigration_rate)
+    def remove_host(self, host):
+        """
+        Removes a Host agent from the schedule and its species pool in constant time.
+        The last host of the pool takes its place, instead of every later host moving up one as with list.remove.
+        """
+
+        pool = [self.hosts_0, self.hosts_1, self.hosts_2, self.hosts_3][host.species_id]
+        last = pool.pop()
+        if last is not host:
+            pool[host.contact_index] = last
+            last.contact_index = host.contact_index
+        self.schedule.remove(host)
+
+    def draw_hosts(self, rate):
+        """
+        Returns the hosts an event happens to this step, drawn once per species with draw_events.
+
+        Hosts keep their own probabilities. Events are drawn with the highest probability of the species,
+        and when some hosts have a lower one each of their events is kept with the ratio of the two,
+        so every host still has the event with its own probability.
+
+        Args:
+            rate: Name of the Host attribute with the probability of the event.
+        """
+
+        hosts = []
+        for pool in [self.hosts_0, self.hosts_1, self.hosts_2, self.hosts_3]:
+            if not pool:
+                continue
+            probabilities = np.fromiter(map(attrgetter(rate), pool), dtype=float, count=len(pool))
+            p = probabilities.max()
+            events = draw_events(len(pool), p, self.rng)
+            if probabilities.min() < p:
+                events = events[self.rng.random(len(events)) * p < probabilities[events]]
+            hosts.extend(pool[i] for i in events)
+        return hosts
+
+    def host_states(self):
+        """Returns the id, species id and boolean virus matrix of every host, as arrays."""
+
+        if self.population is not None:
+            population = self.population
+            hosts = population.hosts()
+            return hosts, population.species[hosts], population.viruses[hosts]
+
+        hosts = self.schedule.agents
+        return (np.asarray([host.unique_id for host in hosts], dtype=np.int64),
+                np.asarray([host.species_id for host in hosts], dtype=np.int8),
+                np.asarray([host.viruses for host in hosts]).reshape(-1, NUM_H, NUM_N) > 0)
+
+    def strain_counts(self):
+        """Returns a species x NUM_H x NUM_N array with the number of hosts infected by each virus."""
+
+        if self.population is not None:
+            return self.population.strain_counts()
+
+        _, species, viruses = self.host_states()
+        counts = np.zeros((len(SPECIES), NUM_H, NUM_N), dtype=np.int64)
+        for i in range(len(SPECIES)):
+            counts[i] = np.count_nonzero(viruses[species == i], axis=0)
+        return counts
 
 
     def immigrate(self, p):
         """
-        A random virus immigrates into a random population with probability p.
-        """
-
-        pass
-
-
-        # Todo: make it so a new immigant replaces and old one instead of being added to the population?
-        #     # Immigration
-        # for i in range(int(self.len_hosts_0 * self.immigration_rate)):
-        #     init_virus = np.zeros(170)
-        #     init_virus[:34] = 1
-        #     rng.shuffle(init_virus)
-        #     init_virus = np.reshape(init_virus, (17, 10))
-        #
-        #     host = Host(self, "Human", init_virus)
-        #     self.schedule.add(host)
-        #     init_virus = None
-        #     self.hosts_0.append(host)
-        # for i in range(int(self.len_hosts_1 * self.immigration_rate)):
-        #     init_virus = np.zeros(170)
-        #     init_virus[:34] = 1
-        #     rng.shuffle(init_virus)
-        #     init_virus = np.reshape(init_virus, (17, 10))
-        #
-        #     host = Host(self, "Pig", init_virus)
-        #     self.schedule.add(host)
-        #     init_virus = None
-        #     self.hosts_1.append(host)
-        # for i in range(int(self.len_hosts_2 * self.immigration_rate)):
-        #     init_virus = np.zeros(170)
-        #     init_virus[:34] = 1
-        #     rng.shuffle(init_virus)
-        #     init_virus = np.reshape(init_virus, (17, 10))
-        #
-        #     host = Host(self, "Bird", init_virus)
-        #     self.schedule.add(host)
-        #     init_virus = None
-        #     self.hosts_2.append(host)
-        # for i in range(int(self.len_hosts_3 * self.immigration_rate)):
-        #     init_virus = np.zeros(170)
-        #     init_virus[:34] = 1
-        #     rng.shuffle(init_virus)
-        #     init_virus = np.reshape(init_virus, (17, 10))
-        #
-        #     host = Host(self, "Poultry", init_virus)
-        #     self.schedule.add(host)
-        #     self.hosts_3.append(host)
-        # #     init_virus = None
+        STAGE 5
+
+        Immigrants arrive, with probability p for each host. The number of immigrants of each species is drawn
+        once per species, and their viruses are drawn for all of them at once, see immigrant_viruses.
+        Immigrants have no immunity. With "replace" immigration each one takes the place of a host of its species.
+        """
+
+        if not p:
+            return
+
+        if self.population is not None:
+            self.population.immigrate(p)
+            return
+
+        pools = [self.hosts_0, self.hosts_1, self.hosts_2, self.hosts_3]
+        if self.immigration == "replace":
+            leaving = [[pool[i] for i in draw_events(len(pool), p, self.rng)] for pool in pools]
+            arrivals = [len(hosts) for hosts in leaving]
+            for hosts in leaving:
+                for host in hosts:
+                    self.remove_host(host)
+        else:
+            arrivals = self.rng.binomial([len(pool) for pool in pools], p)
+
+        species = np.repeat(np.arange(len(SPECIES)), arrivals)
+        for species_id, viruses in zip(species, self.immigrant_viruses(species)):
+            self.add_host(self.host_class(self, SPECIES[species_id], viruses))
+
+    def immigrant_viruses(self, species):
+        """
+        Returns a boolean immigrants x NUM_H x NUM_N array of the viruses immigrants of the given species
+        arrive with, drawn in one go with the probabilities in immigrant_virus_prob.
+        """
+
+        probabilities = np.broadcast_to(self.immigrant_virus_prob, (len(SPECIES), NUM_H, NUM_N))
+        return self.rng.random((len(species), NUM_H, NUM_N)) < probabilities[species]
 
 if __name__ == '__main__':
     pass
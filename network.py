@@ -0,0 +1,118 @@
+"""
+Fixed contact networks for VirusModel. A networkx graph is compiled once into CSR arrays,
+so hosts get exposed to their neighbors' viruses with array operations over the edges.
+"""
+
+import itertools
+
+import networkx as nx
+import numpy as np
+
+from model import SPECIES
+
+
+class ContactNetwork:
+
+    def __init__(self, indptr, indices, species=None):
+        """
+        A contact network in compressed sparse row form. Host k is exposed to the viruses of
+        hosts indices[indptr[k]:indptr[k + 1]] every step.
+
+        Args:
+            indptr: Array of num_hosts + 1 offsets into indices.
+            indices: Array with the neighbors of every host, one host after another.
+            species: Array with the species id of each host, or None to draw them at random.
+        """
+
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.species = None if species is None else np.asarray(species, dtype=np.int8)
+        degrees = np.diff(self.indptr)
+        self.rows = np.repeat(np.arange(len(self)), degrees)  # Host each entry of indices belongs to
+
+        # Neighbor counts are differences of running totals, which are right modulo 2 ** 16 as long as
+        # no host has that many neighbors, so the smaller type can be summed in.
+        self.count_dtype = np.uint16 if len(degrees) == 0 or degrees.max() < 2 ** 16 else np.int32
+
+    @classmethod
+    def from_graph(cls, graph, species_attribute="species"):
+        """
+        Compiles a networkx graph. Every node becomes a host, in the order graph lists them.
+        Hosts are exposed to their neighbors, or to their predecessors in a directed graph.
+
+        Args:
+            graph: The networkx graph or digraph.
+            species_attribute: Node attribute with the species of each host, as a name in SPECIES or an id.
+                When no node has it, species are drawn at random by the model.
+        """
+
+        # The neighbors a host is exposed to are its row of the adjacency, so the CSR arrays are read off it.
+        adjacency = graph.pred if graph.is_directed() else graph.adj
+        nodes = list(adjacency)
+        degrees = np.fromiter(map(len, adjacency.values()), dtype=np.int64, count=len(nodes))
+        neighbors = itertools.chain.from_iterable(adjacency.values())
+        if nodes != list(range(len(nodes))):
+            index = {node: i for i, node in enumerate(nodes)}
+            neighbors = map(index.__getitem__, neighbors)
+        indices = np.fromiter(neighbors, dtype=np.int64, count=degrees.sum())
+        indptr = np.concatenate([[0], np.cumsum(degrees)])
+
+        species = None
+        attributes = nx.get_node_attributes(graph, species_attribute)
+        if attributes:
+            species = [attributes[node] for node in nodes]
+            species = [SPECIES.index(s) if isinstance(s, str) else int(s) for s in species]
+
+        return cls(indptr, indices, species)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    @property
+    def num_edges(self):
+        return len(self.indices)
+
+    def exposures(self, viruses, chunk_size=2 ** 22, sources=None):
+        """
+        Yields the hosts with at least one infected neighbor and how many of their neighbors carry each virus,
+        a few hosts at a time. Together they are the product of the adjacency matrix with the population's
+        viruses, computed over the edges from infected hosts only.
+
+        Args:
+            viruses: Boolean array of the viruses each host carries, one row per host. It may be any
+                block of the NUM_H x NUM_N matrices, and the counts have the same shape.
+            chunk_size: Upper bound on the number of edge virus matrices gathered at once.
+            sources: Boolean array of the hosts whose viruses count, or None for all of them.
+
+        Yields:
+            An array of hosts, and an array of their neighbor counts.
+        """
+
+        shape = viruses.shape[1:]
+        flat = viruses.reshape(len(self), -1)
+        infected = flat.any(axis=1)
+        if sources is not None:
+            infected &= sources
+        live = infected[self.indices]  # Edges whose source is infected
+        rows = self.rows[live]
+        sources = self.indices[live]
+        if not len(rows):
+            return
+
+        # rows is sorted, so each receiver's edges are one run.
+        hosts, starts = np.unique(rows, return_index=True)
+        ends = np.append(starts[1:], len(rows))
+
+        step = max(1, chunk_size // max(1, flat.shape[1]))
+        first = 0
+        while first < len(hosts):
+            # Take whole hosts until about step edges.
+            last = max(first + 1, np.searchsorted(ends, starts[first] + step, side="right"))
+            begin, end = starts[first], ends[last - 1]
+
+            # Running totals of the gathered neighbor viruses, differenced at the end of each host's run.
+            totals = np.cumsum(flat[sources[begin:end]], axis=0, dtype=self.count_dtype)
+            counts = totals[ends[first:last] - begin - 1]
+            counts[1:] -= totals[ends[first:last - 1] - begin - 1]
+            yield hosts[first:last], counts.reshape(-1, *shape)
+            first = last
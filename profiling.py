@@ -0,0 +1,104 @@
+"""
+Optional instrumentation of VirusModel's step loop. Records the wall time, hosts processed
+and random numbers drawn by each stage of every step.
+"""
+
+import time
+from contextlib import contextmanager, nullcontext
+
+import pandas as pd
+from mesa.time import StagedActivation
+
+# Context used in place of a stage timer when profiling is off. Entering it does nothing.
+NOT_PROFILED = nullcontext()
+
+
+class CountingGenerator:
+
+    def __init__(self, rng):
+        """
+        Wraps a numpy Generator and counts the random numbers drawn from it.
+        Only used while profiling, so the plain Generator has no overhead otherwise.
+        """
+
+        self.rng = rng
+        self.draws = 0
+
+    def __getattr__(self, name):
+        # Only called the first time a method is looked up. The counted method is then stored
+        # on the instance, so later draws go straight to it.
+        attribute = getattr(self.rng, name)
+        if not callable(attribute):
+            return attribute
+
+        def counted(*args, **kwargs):
+            result = attribute(*args, **kwargs)
+            self.draws += getattr(result, "size", 1)  # Python scalars have no size
+            return result
+
+        setattr(self, name, counted)
+        return counted
+
+
+class StageProfiler:
+
+    def __init__(self, model):
+        """
+        Records how long each stage of each step of a model takes.
+        Replaces model.rng with a CountingGenerator so draws can be counted.
+        """
+
+        self.model = model
+        self.rng = CountingGenerator(model.rng)
+        model.rng = self.rng
+        self.records = []  # (step, stage, seconds, hosts, draws) of every stage run
+
+    @contextmanager
+    def stage(self, name, hosts):
+        """Times the code run inside the with block as stage name of the current step, processing hosts hosts."""
+
+        draws = self.rng.draws
+        start = time.perf_counter()
+        yield
+        self.records.append((self.model.model_step, name, time.perf_counter() - start, hosts, self.rng.draws - draws))
+
+    def get_dataframe(self):
+        """Returns one row per stage run, with its Step, Stage, Seconds, Hosts and Draws."""
+
+        return pd.DataFrame(self.records, columns=["Step", "Stage", "Seconds", "Hosts", "Draws"])
+
+    def summary(self):
+        """Returns the total time, hosts and draws of each stage, and its share of the total time."""
+
+        summary = self.get_dataframe().groupby("Stage", sort=False)[["Seconds", "Hosts", "Draws"]].sum()
+        summary["Share"] = summary["Seconds"] / summary["Seconds"].sum()
+        return summary
+
+    def write_csv(self, path):
+        """Writes the records to a csv file, to keep alongside the results."""
+
+        self.get_dataframe().to_csv(path, index=False)
+
+    def __getstate__(self):
+        # The model is left behind when sending the records back from a worker process.
+        state = dict(self.__dict__)
+        state["model"] = None
+        state["rng"] = None
+        return state
+
+
+class ProfiledStagedActivation(StagedActivation):
+    """StagedActivation that times every stage with the model's profiler."""
+
+    def step(self):
+        agent_keys = list(self._agents.keys())
+        if self.shuffle:
+            self.model.random.shuffle(agent_keys)
+        for stage in self.stage_list:
+            with self.model.profiler.stage(stage, len(agent_keys)):
+                for agent_key in agent_keys:
+                    getattr(self._agents[agent_key], stage)()  # Run stage
+            if self.shuffle_between_stages:
+                self.model.random.shuffle(agent_keys)
+            self.time += self.stage_time
+        self.steps += 1
@@ -1,11 +1,24 @@
+import networkx as nx
 import numpy as np
 import pandas as pd
+import pytest
 from mesa.batchrunner import BatchRunner
 
-from model import Host, VirusModel, ONES, ZEROS
-from model import VirusModel
+from batch import ParallelBatchRunner, run_model
+from burnin import BurnInCache
+from benchmark import compare, run_benchmarks, run_case, scaled_contact_rates, virus_prob
+from compartments import CompartmentPopulation, decode, encode
+from gillespie import EventPopulation
+from network import ContactNetwork
+from model import Host, VirusModel, ONES, ZEROS, NO_VIRUSES, FULL_SUSCEPTIBILITY
+from model import ENGINES, VirusModel, Population, PackedHost, IndexSet, compile_transmission_table, draw_contacts, draw_events
+from model import infection_probabilities, NUM_H, NUM_N
+import os
 import time
 
+from parameters import infection_table
+from writer import StrainWriter, read_strain_counts
+
 testviruses = np.array(
               [ [1., 1., 1., 1., 0., 0., 1., 1., 1., 1.],
                 [1., 1., 1., 1., 0., 0., 1., 1., 1., 1.],
@@ -191,6 +204,833 @@ class TestClass:
         new_data = new_data.groupby(['Step']).sum().reset_index()
         assert (new_data[new_data.Step == 9].iloc[0]["H8N4"] == 0)
 
+    def test_vectorized_stages_match_agents(self):
+        """The vectorized engine's stages give the same viruses and susceptibility as the per-agent ones."""
+
+        model = VirusModel(init_pop_size=[20, 20, 20, 20])
+        hosts = model.schedule.agents
+        for host in hosts:
+            host.viruses = testviruses2 if host.species_id % 2 else testviruses3
+            host.mutation_prob = 0
+            host.recovery_prob = 1
+        population = Population.from_hosts(model, hosts)
+        population.mutation_prob = 0
+        population.recovery_prob = 1
+
+        for host in hosts:
+            host.recombine()
+        population.recombine()
+        assert np.array_equal(population.viruses, [host.viruses > 0 for host in hosts])
+
+        for host in hosts:
+            host.recover()
+        population.recover()
+        assert np.array_equal(population.viruses, [host.viruses > 0 for host in hosts])
+        assert np.array_equal(population.susceptibility, [host.susceptibility > 0 for host in hosts])
+
+    def test_vectorized_engine(self):
+        """The vectorized engine steps without any Host agents and reports strain counts per species."""
+
+        model = VirusModel(init_pop_size=[50, 50, 50, 50], engine="vectorized")
+        for i in range(3):
+            model.step()
+
+        counts = model.strain_counts()
+        assert len(model.schedule.agents) == 0
+        assert counts.shape == (4, 17, 10)
+        assert np.array_equal(counts.sum(axis=0), model.population.viruses.sum(axis=0))
+
+    def test_packed_recombine(self):
+        """PackedHost recombines the same way as Host."""
+
+        model = VirusModel(init_hosts=False)
+        host = PackedHost(model, "Human")
+        host.mutation_prob = 0
+
+        for viruses, recombined in [(testviruses, testviruses), (testviruses2, testviruses), (testviruses3, ONES)]:
+            host.viruses = viruses
+            host.recombine()
+            assert np.array_equal(host.viruses, recombined)
+
+    def test_packed_recovery(self):
+        """PackedHost ends up with the same susceptibility as Host after recovering."""
+
+        model = VirusModel(init_hosts=False)
+        host = Host(model, "Pig", viruses=testviruses2)
+        packed = PackedHost(model, "Pig", viruses=testviruses2)
+        for h in [host, packed]:
+            h.mutation_prob = 0
+            h.recovery_prob = 1
+            h.recombine()
+            h.recover()
+
+        assert packed.strains == 0
+        assert np.array_equal(packed.viruses, ZEROS)
+        assert np.array_equal(packed.susceptibility, host.susceptibility)
+
+    def test_draw_contacts(self):
+        """Each host gets int(pool size * contact rate) contacts from the pool of each species."""
+
+        pools = [np.arange(0, 10), np.arange(10, 30), np.arange(30, 30), np.arange(30, 70)]
+        contact_rates = np.array([[0.5, 0.1, 0.5, 0],
+                                  [0, 0, 0, 0.25],
+                                  [1, 1, 1, 1],
+                                  [0.2, 0, 0, 0.1]])
+        contacts = draw_contacts(pools, contact_rates, np.random.default_rng(0))
+
+        assert [c.shape for c in contacts] == [(10, 7), (20, 10), (0, 0), (40, 6)]
+        assert np.all(contacts[0][:, :5] < 10)
+        assert np.all((contacts[0][:, 5:] >= 10) & (contacts[0][:, 5:] < 30))
+        assert np.all(contacts[1] >= 30)
+        assert np.all(contacts[3][:, :2] < 10) and np.all(contacts[3][:, 2:] >= 30)
+
+    def test_agent_contacts(self):
+        """Hosts look up contacts of their own species' row, and gather their viruses by index."""
+
+        model = VirusModel(init_pop_size=[10, 10, 10, 10])
+        model.sample_contacts()
+        for host in model.schedule.agents:
+            contacts = host.contacts()
+            expected = int(len(model.hosts_0) * model.contact_rates[host.species_id][0])
+            assert len(contacts) >= expected
+            assert np.array_equal(model.contact_states[host.contact_index + model.species_indices[host.species_id][0]],
+                                  host.viruses)
+
+    def test_binomial_transmission(self):
+        """With certain transmission, a host catches every virus at least one of its contacts carries."""
+
+        model = VirusModel(init_pop_size=[10, 10, 10, 10], transmission="binomial", contact_rates=np.ones((4, 4)))
+        model.transmission_prob = 1
+        model.sample_contacts()
+        for host in model.schedule.agents:
+            host.contract_virus()
+            exposed = model.contact_states[host.contacts()].sum(axis=0) > 0
+            assert np.array_equal(host.temp_viruses > 0, exposed & (infection_table[host.species_id] > 0))
+
+        population = Population.from_hosts(model, model.schedule.agents)
+        population.viruses[:] = True
+        population.refresh(np.arange(len(population)))
+        population.contract_virus()
+        for hosts, table in zip(population.pools, infection_table):
+            assert np.all(population.temp_viruses[hosts] == (table > 0))
+
+    def test_draw_events(self):
+        """Events happen to distinct hosts, about num_hosts * p of them."""
+
+        rng = np.random.default_rng(0)
+        events = draw_events(100000, 0.01, rng)
+        assert len(np.unique(events)) == len(events)
+        assert 800 < len(events) < 1200
+        assert len(draw_events(100, 0, rng)) == 0
+        assert np.array_equal(np.sort(draw_events(100, 1, rng)), np.arange(100))
+
+    def test_model_event_draws(self):
+        """When the model draws events, exactly the hosts it picked recover."""
+
+        model = VirusModel(init_pop_size=[20, 20, 20, 20], event_draws="model")
+        for host in model.schedule.agents:
+            host.viruses = testviruses
+            host.recovery_prob = 1
+            host.death_rate = 0
+        model.step()
+
+        for host in model.schedule.agents:
+            assert np.array_equal(host.viruses, ZEROS)
+            assert not np.array_equal(host.susceptibility, ONES)
+
+        # Hosts keep their own probabilities
+        stubborn = model.hosts_0[0]
+        stubborn.recovery_prob = 0
+        recovered = model.draw_hosts("recovery_prob")
+        assert stubborn not in recovered and len(recovered) == model.schedule.get_agent_count() - 1
+        for host in model.schedule.agents:
+            host.recovery_prob = 0
+        for host in model.hosts_1[::2]:
+            host.recovery_prob = .5
+        recovered = [host for i in range(200) for host in model.draw_hosts("recovery_prob")]
+        assert all(host.recovery_prob == .5 for host in recovered) and 800 < len(recovered) < 1200
+
+    def test_strain_collector(self):
+        """The collector counts strains every step, and they match the per agent snapshots it takes."""
+
+        model = VirusModel(init_pop_size=[30, 30, 30, 30], agent_snapshot_interval=2)
+        for i in range(3):
+            model.step()
+
+        collector = model.datacollector
+        assert collector.counts.shape == (3, 4, 17, 10)
+
+        counts = collector.get_agent_vars_dataframe()
+        assert counts.index.names == ["Step", "Iteration", "Species"]
+        assert len(counts.columns) == 170
+
+        snapshots = collector.get_agent_snapshots_dataframe()
+        assert sorted(set(snapshots.index.get_level_values("Step"))) == [0, 2]
+        summed = snapshots.groupby(["Step", "Iteration", "Species"]).sum()
+        assert np.array_equal(summed.loc[2].values, counts.loc[2].loc[summed.loc[2].index].values)
+
+    def test_parallel_batch_runner(self):
+        """Every parameter combination and iteration is run, and the same seed gives the same counts."""
+
+        def sweep():
+            batch_run = ParallelBatchRunner(VirusModel,
+                                            fixed_parameters={"init_pop_size": [30, 30, 30, 30], "engine": "vectorized"},
+                                            variable_parameters={"it": [0, 1]},
+                                            iterations=2,
+                                            max_steps=5,
+                                            processes=2)
+            batch_run.run_all()
+            return batch_run
+
+        batch_run = sweep()
+        counts = batch_run.get_strain_counts()
+        assert sorted(counts) == [(0, 0), (0, 1), (1, 2), (1, 3)]
+        assert all(c.shape == (5, 4, 17, 10) for c in counts.values())
+
+        data = batch_run.get_strain_dataframe()
+        assert list(data.columns[:5]) == ["it", "Run", "Step", "Iteration", "Species"]
+        assert len(data) == 4 * 5 * 4
+
+        again = sweep().get_strain_counts()
+        assert all(np.array_equal(counts[key], again[key]) for key in counts)
+
+        # A run gives the same counts when run on its own in this process.
+        (key, kwargs), = [run for run in batch_run.runs() if run[0] == (1, 3)]
+        assert np.array_equal(run_model(VirusModel, kwargs, 5).counts, counts[key])
+
+    def test_seeded_models(self):
+        """Models with the same seed and replicate are identical, and different replicates are not."""
+
+        for engine in ["agent", "vectorized"]:
+            runs = []
+            for replicate in [0, 0, 1]:
+                model = VirusModel(init_pop_size=[40, 40, 40, 40], engine=engine, seed=7, replicate=replicate,
+                                   transmission="binomial")
+                for i in range(5):
+                    model.step()
+                runs.append(model.datacollector.counts)
+
+            assert np.array_equal(runs[0], runs[1])
+            assert not np.array_equal(runs[0], runs[2])
+
+    def test_active_strains(self):
+        """The vectorized engine only works in the window of proteins its viruses have, and nothing lies outside it."""
+
+        model = VirusModel(init_pop_size=[1000] * 4, engine="vectorized", init_virus_prob=0)
+        population = model.population
+        assert population.window == (slice(0, 0), slice(0, 0))
+
+        population.viruses[::10, 2, 3] = True
+        population.viruses[::15, 4, 1] = True
+        population.refresh(np.arange(len(population)))
+        assert population.window == (slice(2, 5), slice(1, 4))
+
+        for i in range(5):
+            model.step()
+            H, N = population.window
+            outside = np.ones((17, 10), dtype=bool)
+            outside[H, N] = False
+            assert not population.viruses[:, outside].any()
+            assert np.array_equal(population.strain_counts().sum(axis=0), population.viruses.sum(axis=0))
+
+    def test_stage_profiler(self):
+        """Profiled models record every stage of every step, and profiling does not change the results."""
+
+        stages = {"agent": ["collect", "sample_contacts", "mutate", "contract_virus", "recombine", "recover",
+                            "birth_death", "immigrate"],
+                  "vectorized": ["collect", "contract_virus", "recombine", "recover", "birth_death", "immigrate"]}
+
+        for engine in ["agent", "vectorized"]:
+            runs = []
+            for profile in [False, True]:
+                model = VirusModel(init_pop_size=[40, 40, 40, 40], engine=engine, seed=3, profile=profile)
+                for i in range(3):
+                    model.step()
+                runs.append(model.datacollector.counts)
+            assert np.array_equal(runs[0], runs[1])
+
+            timings = model.profiler.get_dataframe()
+            assert list(timings["Stage"].unique()) == stages[engine]
+            assert list(timings.groupby("Step").size()) == [len(stages[engine])] * 3
+            assert (timings["Seconds"] >= 0).all()
+            assert timings.loc[timings["Stage"] == "contract_virus", "Draws"].sum() > 0
+            assert np.isclose(model.profiler.summary()["Share"].sum(), 1)
+
+        assert VirusModel(init_pop_size=[4, 4, 4, 4]).profiler is None
+
+    def test_benchmark_case(self):
+        """A benchmark case reports its speed and stages, and comparing it with itself finds no regression."""
+
+        rates = scaled_contact_rates(4000, 5)
+        assert np.isclose(np.sum(rates * 1000) / 4, 5)
+        assert np.isclose(1 - (1 - virus_prob(0.15)) ** 170, 0.15)
+
+        result = run_case("vectorized", "contact", 400, "moderate", 0.15, steps=2)
+        assert result["hosts"] == 400 and result["steps"] == 2
+        assert np.isclose(result["host_steps_per_sec"], 400 * result["steps_per_sec"])
+        assert "contract_virus" in result["stages"]
+        assert compare({"cases": [result]}, {"cases": [result]}) == []
+
+        # Engines without meanfield transmission are skipped instead of stopping the run
+        results = run_benchmarks(["vectorized", "gillespie"], ["meanfield"], [400], ["moderate"], [0.15], 2)
+        assert [result["engine"] for result in results] == ["vectorized"]
+
+        # A failing case is recorded and the rest still run, with the results handed over after each one
+        saved = []
+        results = run_benchmarks(["vectorized"], ["contact"], [400], ["unknown", "moderate"], [0.15], 2,
+                                 on_result=lambda cases: saved.append(len(cases)))
+        assert "KeyError" in results[0]["error"] and "error" not in results[1]
+        assert saved == [1, 2]
+        assert compare({"cases": results[1:]}, {"cases": [dict(results[1], error="killed")]}) == [
+            ("vectorized", "contact", 400, "moderate", 0.15)]
+
+    def test_index_set(self):
+        """An IndexSet holds the same hosts as a python set after random adds and removes."""
+
+        rng = np.random.default_rng(0)
+        hosts = IndexSet(50)
+        expected = set()
+        for i in range(200):
+            changed = rng.choice(50, size=rng.integers(1, 6), replace=False)
+            present = rng.random(len(changed)) < .5
+            hosts.update(changed, present)
+            expected |= set(changed[present].tolist())
+            expected -= set(changed[~present].tolist())
+            assert set(hosts.members[:len(hosts)].tolist()) == expected
+            assert all((host in hosts) == (host in expected) for host in range(50))
+
+        assert set(hosts.sample(20, rng).tolist()) <= expected
+        assert len(set(hosts.sample(len(hosts), rng, replace=False).tolist())) == len(hosts)
+
+    def test_gillespie_recovery(self):
+        """Without contacts, about recovery_prob of the infected hosts recover each step, exactly or with tau leaps."""
+
+        for exact_max_hosts in [EventPopulation.exact_max_hosts, 0]:
+            model = VirusModel(init_hosts=False, engine="gillespie", contact_rates=np.zeros((4, 4)))
+            viruses = np.zeros((4000, 17, 10), dtype=bool)
+            viruses[:, 0, 0] = True
+            model.population = EventPopulation(model, np.arange(4000) % 4, viruses)
+            model.population.exact_max_hosts = exact_max_hosts
+            model.step()
+            model.step()
+
+            population = model.population
+            still_infected = population.viruses.any(axis=(1, 2)).mean()
+            assert abs(still_infected - (1 - population.recovery_prob) ** 2) < .03
+            assert sum(len(hosts) for hosts in population.infected) == np.count_nonzero(population.viruses.any(axis=(1, 2)))
+
+            # Recovered hosts are immune to H1 and N1, unless they died afterwards.
+            recovered = ~population.viruses.any(axis=(1, 2)) & ~population.susceptibility.all(axis=(1, 2))
+            assert not population.susceptibility[recovered, 0, :].any()
+            assert recovered.mean() > .1
+
+    def test_gillespie_engine(self):
+        """The gillespie engine runs in a model, is seeded, and only draws events that change something."""
+
+        runs = []
+        for i in range(2):
+            model = VirusModel(init_pop_size=[100, 100, 100, 100], engine="gillespie", seed=5,
+                               contact_rates=np.full((4, 4), .01))
+            for j in range(5):
+                model.step()
+            runs.append(model.datacollector.counts)
+            assert model.schedule.steps == 5
+            assert model.population.events > 0
+
+        assert np.array_equal(runs[0], runs[1])
+        assert runs[0].shape == (5, 4, 17, 10)
+
+    def test_gillespie_growth(self, monkeypatch):
+        """In one step the gillespie engine infects about as many hosts as the vectorized engine, exactly or with tau leaps."""
+
+        def infected(engine):
+            total = 0
+            for seed in range(2):
+                model = VirusModel(init_pop_size=[2000] * 4, engine=engine, seed=seed, init_virus_prob=virus_prob(.01),
+                                   contact_rates=scaled_contact_rates(8000, 30))
+                model.step()
+                total += model.population.viruses[model.population.hosts()].any(axis=(1, 2)).sum()
+            return total
+
+        expected = infected("vectorized")
+        assert .7 * expected < infected("gillespie") < 1.4 * expected  # About 11 times as many when infections chained
+        monkeypatch.setattr(EventPopulation, "exact_max_hosts", 0)
+        assert .7 * expected < infected("gillespie") < 1.4 * expected
+
+    def test_infection_probabilities(self):
+        """The force of infection table matches multiplying out the chance of every contact not passing a virus on."""
+
+        rng = np.random.default_rng(1)
+        sizes = np.array([100, 200, 300, 400])
+        counts = rng.integers(0, 100, size=(4, 17, 10))
+        rates = rng.random((4, 4)) * .05
+        table = infection_probabilities(counts, sizes, rates, .5)
+
+        for i in range(4):
+            escape = np.ones((17, 10))
+            for j in range(4):
+                escape *= (1 - .5 * counts[j] / sizes[j]) ** int(sizes[j] * rates[i][j])
+            assert np.allclose(table[i], 1 - escape)
+
+        assert not infection_probabilities(counts, sizes, np.zeros((4, 4)), 1).any()
+
+    def test_transmission_table(self):
+        """The transmission table folds in the infection table, and transmission only follows its nonzero pairs."""
+
+        table = compile_transmission_table(.5)
+        assert table.shape == (4, 4, 17, 10)
+        assert compile_transmission_table(.5) is table
+        assert np.array_equal(table[:, 2], .5 * (infection_table > 0))
+        assert not table.flags.writeable
+
+        for engine in ["agent", "packed", "vectorized"]:
+            model = VirusModel(init_pop_size=[50, 50, 50, 50], engine=engine, init_virus_prob=.2,
+                               contact_rates=np.full((4, 4), .1))
+            only_pigs_to_humans = np.zeros((4, 4, 17, 10))
+            only_pigs_to_humans[0, 1] = 1
+            model.transmission_table = only_pigs_to_humans
+            if engine == "vectorized":
+                model.population.contract_virus()
+                caught = [model.population.temp_viruses[hosts].any() for hosts in model.population.pools]
+            else:
+                model.sample_contacts()
+                for host in model.schedule.agents:
+                    host.contract_virus()
+                caught = [any(np.any(host.temp_viruses) for host in pool)
+                          for pool in [model.hosts_0, model.hosts_1, model.hosts_2, model.hosts_3]]
+            assert caught == [True, False, False, False]
+
+    def test_meanfield_transmission(self):
+        """Hosts catch viruses as often as the table says, and only those they are susceptible to."""
+
+        model = VirusModel(init_hosts=False, engine="vectorized", transmission="meanfield",
+                           contact_rates=np.full((4, 4), .0001))
+        species = np.repeat([0, 1, 2, 3], 10000)
+        viruses = np.zeros((40000, 17, 10), dtype=bool)
+        viruses[10000:15000, 7, 3] = True  # Half the pigs carry H8N4
+        population = Population(model, species, viruses)
+        population.susceptibility[:5000, 7, 3] = False  # Half the humans are immune to it
+        population.contract_virus()
+
+        expected = infection_probabilities(population.strain_counts(), [10000] * 4, model.contact_rates, .5)[0, 7, 3]
+        assert expected > .05
+        assert not population.temp_viruses[:5000].any()
+        assert abs(population.temp_viruses[5000:10000, 7, 3].mean() - expected) < .02
+        assert population.temp_viruses.sum() == population.temp_viruses[:, 7, 3].sum()
+
+        for engine in ["agent", "packed", "vectorized"]:
+            model = VirusModel(init_pop_size=[50, 50, 50, 50], engine=engine, transmission="meanfield")
+            for i in range(3):
+                model.step()
+            assert model.datacollector.counts.shape == (3, 4, 17, 10)
+
+        with pytest.raises(ValueError):
+            VirusModel(init_pop_size=[4, 4, 4, 4], engine="gillespie", transmission="meanfield")
+
+    def test_compartment_keys(self):
+        """States survive being packed into keys and unpacked."""
+
+        fields = [np.array([0, 3, 2]), np.array([0, 2 ** 17 - 1, 5]), np.array([0, 2 ** 10 - 1, 9]),
+                  np.array([1, 2 ** 17 - 1, 0]), np.array([2 ** 10 - 1, 1, 0])]
+        assert all(np.array_equal(a, b) for a, b in zip(decode(encode(*fields)), fields))
+
+    def test_compartment_population(self):
+        """Hosts in the same state are lumped, and the strain counts are those of the same Population."""
+
+        model = VirusModel(init_hosts=False, engine="compartments")
+        species = np.arange(400) % 4
+        viruses = np.zeros((400, 17, 10), dtype=bool)
+        viruses[:40, 0, 0] = True
+        viruses[40:60, 7, 3] = True
+
+        population = CompartmentPopulation(model, species, viruses)
+        assert len(population) == 400
+        assert len(population.keys) == 4 + 4 + 4  # Uninfected, H1N1 and H8N4 hosts of every species
+        assert np.array_equal(population.strain_counts(), Population(model, species, viruses).strain_counts())
+
+    def test_compartment_recovery(self):
+        """Without contacts, recovery_prob of a million infected hosts recover and become immune in one step."""
+
+        model = VirusModel(init_hosts=False, engine="compartments", contact_rates=np.zeros((4, 4)))
+        population = CompartmentPopulation(model, [0, 1, 2, 3], np.ones((4, 17, 10), dtype=bool))
+        population.counts[:] = 250000
+        population.sizes[:] = 250000
+        model.population = population
+        model.step()
+
+        still_infected = population.strain_counts()[:, 0, 0].sum() / 10 ** 6
+        assert abs(still_infected - (1 - population.recovery_prob) * (1 - population.death_rate)) < .01
+        species, H, N, immune_H, immune_N = decode(population.keys)
+        immune = np.sum(population.counts[(immune_H == 2 ** 17 - 1) & (immune_N == 2 ** 10 - 1)]) / 10 ** 6
+        assert abs(immune - population.recovery_prob) < .01
+        assert population.counts.sum() == 10 ** 6
+
+    def test_compartment_engine(self):
+        """The compartments engine runs a large population in a handful of states, and is seeded."""
+
+        runs = []
+        for i in range(2):
+            model = VirusModel(init_pop_size=[2500000] * 4, engine="compartments", seed=9, init_virus_prob=1e-5,
+                               contact_rates=np.full((4, 4), 1e-7))
+            for j in range(3):
+                model.step()
+            runs.append(model.datacollector.counts)
+            assert model.population.counts.sum() == 10 ** 7
+            assert len(model.population.keys) < 10 ** 4
+
+        assert np.array_equal(runs[0], runs[1])
+        assert runs[0][0].sum() > 0
+
+        with pytest.raises(ValueError):
+            VirusModel(init_pop_size=[4, 4, 4, 4], engine="compartments", agent_snapshot_interval=1)
+
+    def test_compartment_transmission(self, monkeypatch):
+        """Contacts spread viruses in batches of bounded size, and the batch size does not change the outcome."""
+
+        import tracemalloc
+
+        arguments = dict(init_pop_size=[5000] * 4, engine="compartments", seed=4, init_virus_prob=virus_prob(.5),
+                         contact_rates=scaled_contact_rates(20000, 30))
+
+        def infected(model):
+            return model.population.counts[decode(model.population.keys)[1] != 0].sum()
+
+        model = VirusModel(**arguments)
+        before = infected(model)
+        model.step()
+        after = infected(model)
+        assert after > before
+
+        # About 300000 infectious contacts, which took over 600 MB when they were all drawn at once
+        monkeypatch.setattr(CompartmentPopulation, "chunk_size", 170 * 1000)
+        model = VirusModel(**arguments)
+        tracemalloc.start()
+        model.step()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        assert peak < 20 * 2 ** 20
+        assert abs(infected(model) - after) < .05 * after
+
+    def test_contact_network(self):
+        """Compiled neighbor counts are the product of the adjacency matrix with the hosts' viruses."""
+
+        network = ContactNetwork.from_graph(nx.path_graph(["a", "b", "c"]))
+        assert list(network.indptr) == [0, 1, 3, 4]
+        assert list(network.indices) == [1, 0, 2, 1]
+        assert network.species is None
+
+        graph = nx.gnm_random_graph(200, 1000, seed=1, directed=True)
+        network = ContactNetwork.from_graph(graph)
+        viruses = np.random.default_rng(0).random((200, 17, 10)) < .02
+        expected = nx.to_numpy_array(graph).T @ viruses.reshape(200, -1)  # Row i holds the predecessors of i
+
+        counts = np.zeros(expected.shape)
+        for hosts, host_counts in network.exposures(viruses, chunk_size=170 * 50):
+            counts[hosts] = host_counts.reshape(len(hosts), -1)
+        assert np.array_equal(counts, expected)
+
+    def test_network_engine(self):
+        """Hosts on a contact network only infect their neighbors."""
+
+        graph = nx.path_graph(4)
+        nx.set_node_attributes(graph, "Human", "species")
+        model = VirusModel(engine="vectorized", contact_graph=graph, init_virus_prob=0)
+        assert len(model.population) == 4
+        assert model.human_pop_size == 4
+
+        H, N = np.argwhere(np.asarray(infection_table[0]) > 0)[0]
+        model.population.viruses[0, H, N] = True
+        model.population.refresh([0])
+        model.transmission_prob = 1
+        model.population.contract_virus()
+        assert list(model.population.temp_viruses[:, H, N]) == [False, True, False, False]
+
+        model = VirusModel(engine="vectorized", contact_graph=nx.cycle_graph(1000), init_virus_prob=.01)
+        for i in range(3):
+            model.step()
+        assert len(model.population) == 1000
+
+        with pytest.raises(ValueError):
+            VirusModel(engine="agent", contact_graph=graph)
+        with pytest.raises(ValueError):
+            VirusModel(engine="vectorized", transmission="meanfield", contact_graph=graph)
+
+    def test_checkpoint(self, tmp_path):
+        """A model loaded from a checkpoint carries on exactly as the saved one does."""
+
+        cases = [dict(engine=engine) for engine in ENGINES] + [
+            dict(engine="agent", agent_snapshot_interval=2),
+            dict(engine="vectorized", contact_graph=nx.cycle_graph(200), init_virus_prob=.01),
+            dict(engine="vectorized", contact_rates=scaled_contact_rates(160, 5), init_viruses=[(7, 3)])]
+        for arguments in cases:
+            model = VirusModel(init_pop_size=[40, 40, 40, 40], **arguments)
+            if model.population is not None:
+                model.population.recovery_prob = .5
+                model.population.death_rate_factors = np.array([2, 1, 1, 1])
+            else:
+                for host in model.schedule.agents[::2]:
+                    host.recovery_prob = 0
+            for i in range(3):
+                model.step()
+            path = tmp_path / "checkpoint.npz"
+            model.save_checkpoint(path)
+            loaded = VirusModel.load_checkpoint(path)
+            assert loaded.schedule.steps == model.schedule.steps
+            assert not any(np.load(path)[name].dtype.hasobject for name in np.load(path).files)  # Nothing pickled
+            if model.population is not None:
+                assert loaded.population.recovery_prob == .5
+                assert np.array_equal(loaded.population.death_rate_factors, [2, 1, 1, 1])
+            else:
+                rates = {host.unique_id: host.recovery_prob for host in model.schedule.agents}
+                assert all(host.recovery_prob == rates[host.unique_id] for host in loaded.schedule.agents)
+
+            for i in range(3):
+                model.step()
+                loaded.step()
+            assert np.array_equal(loaded.datacollector.counts, model.datacollector.counts)
+            assert len(loaded.datacollector.agent_snapshots) == len(model.datacollector.agent_snapshots)
+            if model.population is None:
+                assert [host.unique_id for host in loaded.schedule.agents] == [host.unique_id for host in model.schedule.agents]
+
+    def test_parameter_cache(self, tmp_path, monkeypatch):
+        """Tables are built once into the cache and read back from it after that."""
+
+        import parameters
+        monkeypatch.setattr(parameters, "CACHE_DIR", str(tmp_path))
+
+        table = parameters.load_table("transmission_fitness")
+        assert (tmp_path / "transmission_fitness.npy").exists()
+        assert np.array_equal(table, parameters.build_transmission_fitness())
+
+        monkeypatch.setitem(parameters.TABLES, "transmission_fitness", None)  # Building again would fail
+        assert np.array_equal(parameters.load_table("transmission_fitness", mmap_mode="r"), table)
+        assert np.array_equal(infection_table, parameters.build_infection_table())
+
+    def test_burn_in_cache(self, tmp_path, monkeypatch):
+        """A burned in model gives the same run whether it was cached or not, and old entries are evicted."""
+
+        arguments = dict(init_pop_size=[40, 40, 40, 40], engine="vectorized", seed=3)
+        cache = BurnInCache(tmp_path)
+        assert cache.key(VirusModel, arguments, 5) == cache.key(VirusModel, dict(arguments, replicate=0), 5)
+        assert cache.key(VirusModel, arguments, 5) != cache.key(VirusModel, dict(arguments, seed=4), 5)
+
+        runs = []
+        for i in range(2):  # A miss, then a hit
+            model = cache.get_model(VirusModel, arguments, 5)
+            assert model.schedule.steps == 5 and not model.datacollector.steps
+            for j in range(3):
+                model.step()
+            runs.append(model.datacollector.counts)
+        assert np.array_equal(runs[0], runs[1])
+        assert len(list(tmp_path.glob("*.npz"))) == 1
+
+        collector = run_model(VirusModel, arguments, 8, burn_in_steps=5, burn_in_cache=str(tmp_path))
+        assert np.array_equal(collector.counts, runs[0])
+
+        cache.max_bytes = 1
+        cache.get_model(VirusModel, dict(arguments, seed=4), 5)
+        assert [path.name for path in tmp_path.glob("*.npz")] == [cache.key(VirusModel, dict(arguments, seed=4), 5) + ".npz"]
+
+        # Another process evicting the new entry before it is loaded again gives the same model
+        cache.evict = lambda: [path.unlink() for path in tmp_path.glob("*.npz")]
+        model = cache.get_model(VirusModel, arguments, 5)
+        for j in range(3):
+            model.step()
+        assert np.array_equal(model.datacollector.counts, runs[0])
+        assert not list(tmp_path.glob("*.npz"))
+
+        # A hit whose file is evicted after loading is still used, without running the burn in again
+        del cache.evict
+        cache.get_model(VirusModel, arguments, 5)
+        monkeypatch.setattr(os, "utime", lambda path: os.remove(path) or os.stat(path))
+        monkeypatch.setattr(VirusModel, "step", lambda model: pytest.fail("burn in was run again"))
+        assert cache.get_model(VirusModel, arguments, 5).schedule.steps == 5
+
+    def test_host_layout(self):
+        """Hosts keep their state in slots, share the empty state until infected and report each virus."""
+
+        model = VirusModel(init_hosts=False)
+        healthy = Host(model, "Bird")
+        sick = Host(model, "Bird", viruses=testviruses2)
+        for host in (healthy, sick, PackedHost(model, "Pig")):
+            assert not vars(host)  # Nothing outside the slots
+        assert healthy.viruses is NO_VIRUSES and healthy.susceptibility is FULL_SUSCEPTIBILITY
+        assert sick.viruses.dtype == bool and sick.H1N1 == 1 and sick.H3N1 == 0
+
+        healthy.mutation_prob = 0
+        healthy.recombine()
+        healthy.recovery_prob = 1
+        healthy.recover()
+        assert healthy.viruses is NO_VIRUSES and healthy.susceptibility is FULL_SUSCEPTIBILITY
+
+        sick.recovery_prob = 1
+        sick.recover()
+        assert sick.viruses is NO_VIRUSES and not sick.susceptibility[0].any()
+        assert not NO_VIRUSES.any() and FULL_SUSCEPTIBILITY.all()
+
+    def test_host_pool(self, tmp_path):
+        """Removed hosts free their rows for the next hosts added, and every index of hosts stays consistent."""
+
+        for engine in ["vectorized", "gillespie"]:
+            model = VirusModel(init_pop_size=[50, 50, 50, 50], engine=engine, init_virus_prob=.05)
+            population = model.population
+            removed = np.arange(0, 200, 3)
+            population.remove_hosts(removed)
+            assert len(population) == 200 - len(removed) and population.capacity == 200
+            assert not np.isin(np.concatenate(population.pools), removed).any()
+            assert not np.isin(np.concatenate([hosts.members[:len(hosts)] for hosts in population.infected]), removed).any()
+            model.step()
+
+            rows = population.add_hosts(np.full(len(removed) + 10, 2), np.ones((len(removed) + 10, NUM_H, NUM_N)))
+            assert np.array_equal(rows[:len(removed)], removed) and population.capacity == 400
+            assert len(population.pools[2]) == np.count_nonzero(population.species == 2)
+            assert set(rows) <= set(population.infected[2].members[:len(population.infected[2])])
+            for i, hosts in enumerate(population.pools):
+                assert np.all(population.species[hosts] == i)
+            model.step()
+
+            # A checkpoint keeps the free rows and the order of every pool.
+            model.save_checkpoint(tmp_path / "pool.npz")
+            resumed = VirusModel.load_checkpoint(tmp_path / "pool.npz")
+            model.step()
+            resumed.step()
+            assert np.array_equal(resumed.population.viruses, model.population.viruses)
+
+        model = VirusModel(init_pop_size=[10, 10, 10, 10])
+        for host in list(model.hosts_1[:4]):
+            model.remove_host(host)
+        pools = [model.hosts_0, model.hosts_1, model.hosts_2, model.hosts_3]
+        assert sum(len(pool) for pool in pools) == len(model.schedule.agents) == 36
+        assert all(host.contact_index == i for pool in pools for i, host in enumerate(pool))
+        model.step()
+
+    def test_immigration(self):
+        """Immigrants arrive for about immigration_rate of the hosts, carrying viruses from immigrant_virus_prob."""
+
+        virus_prob = np.zeros((NUM_H, NUM_N))
+        virus_prob[4, 0] = 1  # Every immigrant carries H5N1 and nothing else
+        for engine in ENGINES:
+            for immigration in ["replace", "append"]:
+                model = VirusModel(init_pop_size=[500, 500, 500, 500], engine=engine, init_virus_prob=1e-12,
+                                   immigration=immigration, immigrant_virus_prob=virus_prob)
+                size = len(model.population) if model.population is not None else model.schedule.get_agent_count()
+                model.immigrate(.1)
+                counts = model.strain_counts()
+                assert 140 < counts[:, 4, 0].sum() < 260
+                assert counts.sum() == counts[:, 4, 0].sum()
+
+                new_size = len(model.population) if model.population is not None else model.schedule.get_agent_count()
+                if immigration == "replace":
+                    assert new_size == size
+                else:
+                    assert new_size == size + counts[:, 4, 0].sum()
+                if model.population is not None:  # Stepping agents after remove_host is covered by test_host_pool
+                    model.step()
+
+        with pytest.raises(ValueError):
+            VirusModel(engine="vectorized", contact_graph=nx.cycle_graph(10), immigration="append", immigration_rate=.1)
+
+    def test_empty_population(self):
+        """A vectorized model with no hosts steps, and grows from empty with append immigration."""
+
+        for arguments in [dict(init_hosts=False), dict(init_pop_size=[0, 0, 0, 0])]:
+            model = VirusModel(engine="vectorized", immigration="append", immigration_rate=.5, **arguments)
+            model.step()
+            assert len(model.population) == 0
+
+            model.population.add_hosts(np.arange(4), model.immigrant_viruses(np.arange(4)))
+            for i in range(5):
+                model.step()
+            assert len(model.population) > 4
+
+    def test_strain_writer(self, tmp_path):
+        """Streamed strain counts match the ones kept in memory, and are on disk before the run ends."""
+
+        arguments = dict(init_pop_size=[40, 40, 40, 40], engine="vectorized", seed=3)
+        expected = run_model(VirusModel, arguments, 8).get_agent_vars_dataframe()
+
+        path = str(tmp_path / "run.csv")
+        model = VirusModel(**arguments)
+        model.datacollector.stream(StrainWriter(path, model.datacollector.species, row_group_steps=3, format="csv"))
+        for i in range(4):
+            model.step()
+        assert not model.datacollector.strain_counts
+        assert len(read_strain_counts(path)) == 3 * 4  # A row group of 3 steps, as a crash would leave it
+
+        for i in range(4):
+            model.step()
+        model.datacollector.close()
+        assert model.datacollector.writer is None
+        pd.testing.assert_frame_equal(model.datacollector.get_agent_vars_dataframe(), expected, check_dtype=False)
+        assert np.array_equal(model.datacollector.counts, run_model(VirusModel, arguments, 8).counts)
+
+        collector = run_model(VirusModel, arguments, 8, output_path=str(tmp_path / "batch.csv"))
+        pd.testing.assert_frame_equal(collector.get_agent_vars_dataframe(), expected, check_dtype=False)
+
+        # A run that collects nothing after its burn in leaves empty output
+        collector = run_model(VirusModel, arguments, 3, burn_in_steps=3, output_path=str(tmp_path / "empty.csv"))
+        assert collector.get_agent_vars_dataframe().empty
+        assert collector.counts.shape == (0, 4, NUM_H, NUM_N)
+
+    def test_strain_writer_parquet(self, tmp_path):
+        """Parquet output is written one complete part per row group, and reads back like the in memory counts."""
+
+        pytest.importorskip("pyarrow")
+        arguments = dict(init_pop_size=[40, 40, 40, 40], engine="vectorized", seed=3)
+        expected = run_model(VirusModel, arguments, 8).get_agent_vars_dataframe()
+
+        path = str(tmp_path / "run.parquet")
+        model = VirusModel(**arguments)
+        model.datacollector.stream(StrainWriter(path, model.datacollector.species, row_group_steps=3, format="parquet"))
+        for i in range(4):
+            model.step()
+        assert sorted(os.listdir(path)) == ["part-00000.parquet"]
+        assert len(read_strain_counts(path)) == 3 * 4
+
+        for i in range(4):
+            model.step()
+        model.datacollector.close()
+        assert sorted(os.listdir(path)) == ["part-00000.parquet", "part-00001.parquet", "part-00002.parquet"]
+        pd.testing.assert_frame_equal(model.datacollector.get_agent_vars_dataframe(), expected, check_dtype=False)
+        assert np.array_equal(model.datacollector.counts, run_model(VirusModel, arguments, 8).counts)
+
+        # Appending goes on from the last part, and writing afresh replaces them
+        with StrainWriter(path, model.datacollector.species, format="parquet", append=True) as writer:
+            writer.write(9, 0, model.strain_counts())
+        assert len(read_strain_counts(path)) == 9 * 4
+        StrainWriter(path, model.datacollector.species, format="parquet").close()
+        assert read_strain_counts(path).empty
+
+        collector = run_model(VirusModel, arguments, 3, burn_in_steps=3, output_path=str(tmp_path / "empty.parquet"))
+        assert collector.get_agent_vars_dataframe().empty
+        assert collector.counts.shape == (0, 4, NUM_H, NUM_N)
+
+    def test_host_buffers(self):
+        """Infected hosts recombine and recover into their own arrays, never the model's scratch arrays or ones handed to them."""
+
+        model = VirusModel(init_hosts=False)
+        host = Host(model, "Human", viruses=testviruses2)
+        host.mutation_prob = 0
+        viruses, H, N = host.viruses, host.H, host.N
+        host.recombine()
+        assert host.viruses is viruses and host.H is H and host.N is N
+        assert np.array_equal(host.viruses, testviruses)
+
+        given = testviruses2.copy()
+        host.viruses = given
+        host.recombine()
+        assert np.array_equal(given, testviruses2)  # Not written to, it is not the host's
+        buffers = model.buffers
+        assert all(array is not buffer for array in (host.viruses, host.H, host.N)
+                   for buffer in (buffers.viruses, buffers.H, buffers.N))
+
+        host.clear_infection()
+        susceptibility = host.susceptibility
+        host.temp_viruses = testviruses3 > 0
+        host.recombine()
+        host.clear_infection()
+        assert host.susceptibility is susceptibility and not host.susceptibility.any()
+
     def test_reassortment(self):
         class Ex:
             def __init__(self):
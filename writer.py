@@ -0,0 +1,147 @@
+"""
+Streaming output of VirusModel runs. The strain counts of every collected step are appended to a file
+as the run goes, instead of kept in memory until the end, so memory stays flat however long a run is
+and a run that crashes still leaves the steps it got through.
+"""
+
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+
+from collector import strain_names
+from model import NUM_H, NUM_N
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Optional, only needed for Parquet output
+    pa = None
+    pq = None
+
+# Formats a StrainWriter can write.
+# "parquet" writes a directory of Parquet files, one per row group, each complete as soon as it is written.
+# "csv" appends rows to one CSV file, which the R scripts read directly.
+FORMATS = ["parquet", "csv"]
+
+# Columns of the written rows, in order
+INDEX_COLUMNS = ["Step", "Iteration", "Species"]
+COLUMNS = INDEX_COLUMNS + strain_names(NUM_H, NUM_N)
+
+
+def default_format():
+    """Returns "parquet" when pyarrow is installed, else "csv"."""
+
+    return "csv" if pa is None else "parquet"
+
+
+def read_strain_counts(path):
+    """
+    Reads what a StrainWriter wrote into a dataframe like StrainCollector.get_agent_vars_dataframe,
+    with one row per step and species, indexed by Step, Iteration and Species.
+    Output of a run that collected no steps gives an empty dataframe with the same columns.
+    """
+
+    if os.path.isdir(path):
+        if pq is None:
+            raise ImportError("Reading Parquet output needs pyarrow. Install it with pip install pyarrow")
+        parts = sorted(glob.glob(os.path.join(path, "part-*.parquet")))
+        frame = pd.concat([pq.read_table(part).to_pandas() for part in parts], ignore_index=True) if parts else None
+    else:
+        frame = pd.read_csv(path)
+
+    if frame is None or not len(frame):
+        frame = pd.DataFrame({column: pd.Series(dtype=object if column == "Species" else np.int64) for column in COLUMNS})
+    return frame.set_index(INDEX_COLUMNS)
+
+
+class StrainWriter:
+
+    def __init__(self, path, species, row_group_steps=256, format=None, append=False):
+        """
+        Appends the strain counts of each step to path, in the layout of StrainCollector.get_agent_vars_dataframe:
+        a Step, Iteration and Species column, then one count column per virus, with one row per step and species.
+
+        Steps are buffered and written row_group_steps at a time. With the default of 256 steps a row group
+        holds about a thousand rows, large enough to read efficiently. At most that many steps are lost
+        if the run crashes.
+
+        Args:
+            path: Directory to write Parquet files to, or the CSV file to write.
+            species: Names of the species, in species id order.
+            row_group_steps: Number of steps written at a time.
+            format: One of FORMATS. Defaults to default_format().
+            append: If True, add to what is already at path, such as when a run resumes from a checkpoint.
+                Otherwise earlier output at path is replaced.
+        """
+
+        self.path = path
+        self.species = list(species)
+        self.row_group_steps = row_group_steps
+        self.format = format or default_format()
+        if self.format not in FORMATS:
+            raise ValueError(f"format must be one of {FORMATS}, not {self.format!r}")
+        if self.format == "parquet" and pa is None:
+            raise ImportError("Parquet output needs pyarrow. Install it with pip install pyarrow, or use format=\"csv\"")
+
+        self.steps = []  # Step and iteration of each buffered step
+        self.counts = []  # Species x NUM_H x NUM_N count array of each buffered step
+
+        if self.format == "parquet":
+            os.makedirs(path, exist_ok=True)
+            parts = sorted(glob.glob(os.path.join(path, "part-*.parquet")))
+            if not append:
+                for part in parts:
+                    os.remove(part)
+                parts = []
+            self.num_parts = int(os.path.basename(parts[-1])[5:-8]) + 1 if parts else 0
+        else:
+            # The header is written straight away, so a run that collects no steps still leaves a readable file.
+            if not (append and os.path.exists(path) and os.path.getsize(path)):
+                pd.DataFrame(columns=COLUMNS).to_csv(path, index=False)
+
+    def write(self, step, iteration, counts):
+        """Adds the species x NUM_H x NUM_N strain counts of one step, writing a row group when enough are buffered."""
+
+        self.steps.append((step, iteration))
+        self.counts.append(np.asarray(counts))
+        if len(self.steps) >= self.row_group_steps:
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered steps."""
+
+        if not self.steps:
+            return
+
+        counts = np.stack(self.counts)
+        steps, iterations = np.array(self.steps, dtype=np.int64).T
+        frame = pd.DataFrame(counts.reshape(len(counts) * len(self.species), -1), columns=COLUMNS[len(INDEX_COLUMNS):])
+        frame.insert(0, "Species", np.tile(self.species, len(steps)))
+        frame.insert(0, "Iteration", np.repeat(iterations, len(self.species)))
+        frame.insert(0, "Step", np.repeat(steps, len(self.species)))
+
+        if self.format == "parquet":
+            # Written under a name the reader skips, then renamed, so a part is either complete or absent.
+            name = f"part-{self.num_parts:05d}.parquet"
+            temp_path = os.path.join(self.path, "." + name)
+            pq.write_table(pa.Table.from_pandas(frame, preserve_index=False), temp_path)
+            os.replace(temp_path, os.path.join(self.path, name))
+            self.num_parts += 1
+        else:
+            frame.to_csv(self.path, mode="a", header=False, index=False)
+
+        self.steps = []
+        self.counts = []
+
+    def close(self):
+        """Writes whatever is still buffered."""
+
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()